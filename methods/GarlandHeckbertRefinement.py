@@ -1,18 +1,55 @@
 import collections
 import sys
-import threading
 
 import startinpy
 
 import numpy as np
 
-from math import floor
-from scipy.spatial import KDTree
-from heapq import *
+from functools import partial
+
+from cell_pool import CellPool
+from cell_subdivision import CellSubdivider
+from corner_seeds import CornerSeeds, nearest_z_values
+from insertion_log import InsertionLog, encode_insertions, encode_text, insertion_rows
+from lod_output import LevelsOfDetail, cut_levels
+from pending_cells import PendingCells
+from point_buffer import as_array
+from reorder_buffer import ReorderBuffer
+from stream_parser import read_events
+from stream_writer import StreamWriter
+from triangle_buckets import TriangleBuckets
+from vertex_format import format_vertices
+from versioned_heap import VersionedHeap
 
 
 TRIANGULATION_THRESHOLD = 0.2
 
+# Digits after the decimal point of output vertices; None writes them exactly like str(float)
+OUTPUT_PRECISION = None
+
+# Bytes of finished cells held back to keep the output in stream order; 0 writes cells as soon as they finish
+REORDER_BUFFER_SIZE = 1 << 28
+
+# Bytes of points of cells waiting for a worker kept in memory, and spilled to disk after that, before input is paused
+PENDING_MEMORY_BUDGET = 1 << 30
+SPILL_BUDGET = 1 << 36
+
+# Number of long-lived worker processes finalizing cells; None uses all cores not taken by sstfin and sstdt
+PROCESS_COUNT = None
+
+# Cells with more points than this are split into quadtree sub-cells that are refined in parallel, seeded with shared
+# points on their common boundaries and written back as one cell; None never splits a cell
+SUBDIVISION_THRESHOLD = None
+
+# Path of a binary sidecar recording every cell's insertions with their errors, or None; tools/extract_insertion_log.py
+# cuts it into the output for any threshold of at least TRIANGULATION_THRESHOLD without triangulating again
+INSERTION_LOG = None
+
+# List of (threshold, path) of coarser levels of detail written in the same pass, or None; every path (a file or a FIFO
+# read by another sstdt) gets the output of a run at its threshold, cut from the insertions of the cells refined down to
+# TRIANGULATION_THRESHOLD, so no threshold may be below that
+LEVELS_OF_DETAIL = None
+
 
 def shift_left(input_list):
     collection = collections.deque(input_list)
@@ -21,18 +58,17 @@ def shift_left(input_list):
 
 
 class Triangle:
-    def __init__(self):
-        self.vertices = {}
-        self.triangle_vertex_ids = []
+    def __init__(self, triangle_vertex_ids, point_indexes):
+        self.triangle_vertex_ids = triangle_vertex_ids
+
+        # Indexes (into the cell's points) of the points inside this triangle that have not been inserted yet
+        self.point_indexes = point_indexes
 
         self.point_index = -1
         self.max_error = 0
 
-    def __lt__(self, other):
-        return self.max_error < other.max_error
-
     def __str__(self):
-        return str("max index: " + str(self.point_index) + ", error: " + str(-self.max_error) + ", len vertices: " + str(len(self.vertices)))
+        return str("max index: " + str(self.point_index) + ", error: " + str(-self.max_error) + ", len vertices: " + str(len(self.point_indexes)))
 
 
 class Triangulation:
@@ -61,208 +97,231 @@ class Triangulation:
         self.grid_dimensions = grid_size
         self.grid_points = np.empty(shape=(grid_size, grid_size), dtype=object)
 
-    def insert_point_in_grid(self, x, y, z):
-        grid_cell = self.get_cell(x, y)
+    def insert_points_in_grid(self, points):
+        grid_x, grid_y = self.get_cell(points[:, 0], points[:, 1])
 
-        if type(self.grid_points[grid_cell[0]][grid_cell[1]]) == list:
-            self.grid_points[grid_cell[0]][grid_cell[1]].append([x, y, z])
-        else:
-            self.grid_points[grid_cell[0]][grid_cell[1]] = [[x, y, z]]
+        # Group the batch by cell so each cell gets one block appended instead of one list per point
+        cells, cell_indexes = np.unique(np.c_[grid_x, grid_y], axis=0, return_inverse=True)
+        cell_indexes = cell_indexes.ravel()
 
-    def get_cell(self, x, y):
-        return floor((x - self.min_x) / self.cell_size), floor((y - self.min_y) / self.cell_size)
+        # One sort for the whole batch; stable, so every block keeps the stream order of its points
+        order = np.argsort(cell_indexes, kind="stable")
+        blocks = np.split(points[order], np.searchsorted(cell_indexes[order], np.arange(1, len(cells))))
 
-    def get_corner_points(self, grid_x, grid_y):
-        x_vals = []
-        y_vals = []
+        for (cell_x, cell_y), block in zip(cells.tolist(), blocks):
+            if type(self.grid_points[cell_x][cell_y]) == list:
+                self.grid_points[cell_x][cell_y].append(block)
+            else:
+                self.grid_points[cell_x][cell_y] = [block]
 
-        for point in self.grid_points[grid_x][grid_y]:
-            x_vals.append(point[0])
-            y_vals.append(point[1])
+    def take_cell(self, grid_x, grid_y):
+        # A finalizer outside the grid has no points; its cell gets no work instead of aborting the stream
+        if not (0 <= grid_x < self.grid_dimensions and 0 <= grid_y < self.grid_dimensions):
+            return np.empty((0, 3))
 
-        tree = KDTree(np.c_[x_vals, y_vals])
+        blocks = self.grid_points[grid_x][grid_y]
 
-        # Determine 4 corner points for this grid cell to initialize triangulation
-        corner_points = [
-            [self.min_x + (self.cell_size * grid_x), self.min_y + (self.cell_size * grid_y)],
-            [self.min_x + (self.cell_size * grid_x) + self.cell_size - 1E-5, self.min_y + (self.cell_size * grid_y)],
-            [self.min_x + (self.cell_size * grid_x), self.min_y + (self.cell_size * grid_y) + self.cell_size - 1E-5],
-            [self.min_x + (self.cell_size * grid_x) + self.cell_size - 1E-5, self.min_y + (self.cell_size * grid_y) + self.cell_size - 1E-5]
-        ]
+        # The cell is done once its finalizer arrives; drop its points so memory stays bounded by the open cells
+        self.grid_points[grid_x][grid_y] = None
 
-        near_corner_points = []
+        if blocks is None:
+            return np.empty((0, 3))
 
-        for corner_point in corner_points:
-            # Get nearest k points to corner points
-            distances, indexes = tree.query(corner_point, k=10)
+        return np.concatenate(blocks)
 
-            z_vals = [self.grid_points[grid_x][grid_y][index][2] for index in indexes]
+    def get_cell(self, x, y):
+        return np.floor((x - self.min_x) / self.cell_size).astype(np.int64), np.floor((y - self.min_y) / self.cell_size).astype(np.int64)
 
-            # Add a corner point with average z value of k nearest
-            near_corner_points.append([corner_point[0], corner_point[1], sum(z_vals) / len(z_vals)])
+    def get_corner_points(self, corner_seeds, points):
+        near_corner_points = []
 
-        del tree
-        del x_vals
-        del y_vals
-        del z_vals
+        # Points near the corners were picked out while the cell was read; only sparse corners need the whole cell
+        for x, y, z_vals in nearest_z_values(corner_seeds, points):
+            z_vals = z_vals.tolist()
 
-        return near_corner_points
+            # Add a corner point with average z value of k nearest
+            near_corner_points.append([x, y, sum(z_vals) / len(z_vals)])
 
-    def scan_triangle(self, triangulation, heap, input_triangle, points):
-        best = None
-        max_error = 0
+        return near_corner_points
 
-        # Create a new Triangle for in the heap and set the vertex indexes that define this triangle
-        output_triangle = Triangle()
-        output_triangle.triangle_vertex_ids = input_triangle
+    def scan_triangles(self, heap, alive, assigned):
+        for key, triangle, point_indexes, errors in assigned:
+            output_triangle = Triangle(triangle, point_indexes)
+            alive[key] = output_triangle
 
-        # Adjacent triangles may also include relevant points because of flipping
-        adjacent_triangles = triangulation.adjacent_triangles_to_triangle(input_triangle)
+            # A triangle rescanned after a duplicate insertion replaces its own older heap entry
+            heap.discard(key)
 
-        # The points we have are from the old triangle, after inserting a point we need to find which are in the new one
-        # and determine the point of maximum error within this triangle
-        for i in points:
-            point = points[i]
+            if len(point_indexes) == 0:
+                continue
 
-            in_triangle = triangulation.locate(point[0], point[1])
+            best = errors.argmax()
 
-            # Triangle ordering may be different;
-            # check if all points are in both lists [1, 2, 3] == [3, 1, 2] == [2, 3, 1]
-            is_inside_triangle = all(vertex in input_triangle for vertex in in_triangle)
+            if errors[best] > 0:
+                # Push worst abs vertex to triangle & heap
+                output_triangle.max_error = -errors[best]
+                output_triangle.point_index = point_indexes[best]
 
-            # Assign each point that is within the new triangle to the new triangle and check if its error is largest
-            if is_inside_triangle:
-                output_triangle.vertices[i] = point
+                heap.push(key, output_triangle.max_error)
 
-                try:
-                    error = abs(point[2] - triangulation.interpolate_tin_linear(point[0], point[1]))
+    def insert(self, triangulation, heap, buckets, alive, triangle):
+        destroyed, assigned = buckets.insert(triangulation, triangle.point_index)
 
-                    if error > max_error:
-                        max_error = error
-                        best = i
-                except:
-                    pass
+        for key in destroyed:
+            del alive[key]
 
-            else:
-                # Check if a point exists in an adjacent triangle as this point may be relevant after a flip operation
-                for adjacent_triangle in adjacent_triangles:
+            # Its heap entry goes stale and is dropped when it reaches the top (or when the heap is compacted)
+            heap.discard(key)
 
-                    is_inside_triangle = all(vertex in adjacent_triangle for vertex in in_triangle)
+        self.scan_triangles(heap, alive, assigned)
 
-                    if is_inside_triangle:
-                        output_triangle.vertices[i] = point
-                        break
+    def finalize(self, input_line, grid_x, grid_y, corner_seeds, points_in_cell):
+        points = as_array(points_in_cell)
 
-        if best is not None:
-            # Push worst abs vertex to triangle & heap
-            output_triangle.max_error = -max_error
-            output_triangle.point_index = best
+        corner_points = self.get_corner_points(corner_seeds, points)
 
-            heappush(heap, output_triangle)
+        triangulation = startinpy.DT()
 
-    def insert(self, triangulation, heap, index, vertices):
-        vertex_id = triangulation.insert_one_pt(vertices[index][0], vertices[index][1], vertices[index][2], 0)
+        # Triangles keyed by their sorted vertex ids, worst error first
+        heap = VersionedHeap()
 
-        incident_triangles = triangulation.incident_triangles_to_vertex(vertex_id)
+        # Insert 4 corner points into triangulation
+        triangulation.insert(corner_points)
 
-        # Inserted this point, no need to keep it in our list of vertices for later triangles
-        del vertices[index]
+        # The points of the cell bucketed by the triangle they are in; the corners get vertex ids 1 to 4
+        buckets = TriangleBuckets(points, enumerate(corner_points, start=1))
 
-        # If there is only 1 point in this triangle, then no need to continue search as max granularity is reached
-        if incident_triangles is not None and len(vertices) > 1:
-            for triangle in incident_triangles:
-                self.scan_triangle(triangulation, heap, triangle, vertices)
+        # Live triangles by sorted vertex ids
+        alive = {}
 
-    def finalize(self, grid_x, grid_y, input_line, thread_id):
-        all_points = {}
-        points_in_cell = self.grid_points[grid_x][grid_y]
+        # Get largest delta for initial 2 triangles and push to heap; points outside the corners' hull are left out
+        assigned, _ = buckets.assign(triangulation.all_triangles(), np.arange(len(points)))
+        self.scan_triangles(heap, alive, assigned)
 
-        if points_in_cell is None or len(points_in_cell) == 0:
-            sys.stdout.write(input_line)
-            return
+        # Error of every vertex inserted from here on, in insertion order
+        errors = []
 
-        for i in range(len(points_in_cell)):
-            all_points[i] = points_in_cell[i]
+        while heap:
+            # Get largest delta from heap; triangles destroyed by an earlier insertion are never returned
+            _, key = heap.pop()
+            max_abs = alive[key]
 
-        corner_points = self.get_corner_points(grid_x, grid_y)
+            # If below threshold, we're done!
+            if -max_abs.max_error < TRIANGULATION_THRESHOLD:
+                break
 
-        triangulation = startinpy.DT()
+            vertex_count = triangulation.number_of_vertices()
 
-        heap = []
+            # If not below threshold, insert it and add delta's for each incident triangle to heap
+            self.insert(triangulation, heap, buckets, alive, max_abs)
 
-        # Insert 4 corner points into triangulation
-        triangulation.insert(corner_points)
+            # A duplicate of an existing vertex adds no vertex to log
+            if triangulation.number_of_vertices() > vertex_count:
+                errors.append(-max_abs.max_error)
 
-        # Get largest delta for initial 2 triangles and push to heap
-        for triangle in triangulation.all_triangles():
-            self.scan_triangle(triangulation, heap, triangle, all_points)
+        triangulation_vertices = triangulation.all_vertices()
 
-        while heap:
-            # Get largest delta from heap
-            max_abs = heappop(heap)
+        # The cell's block goes back to the main process, which writes it in finalizer order
+        output = format_vertices(triangulation_vertices, precision=OUTPUT_PRECISION) + input_line
 
-            # sys.stdout.write("Thread-{}: {}\n".format(thread_id, max_abs))
-            # sys.stdout.flush()
+        if LEVELS_OF_DETAIL is None and INSERTION_LOG is None:
+            return output
 
-            # If below threshold, we're done!
-            if -max_abs.max_error < TRIANGULATION_THRESHOLD:
-                break
+        rows = insertion_rows(triangulation_vertices, errors)
 
-            # If not below threshold, insert it and add delta's for each incident triangle to heap
-            self.insert(triangulation, heap, max_abs.point_index, max_abs.vertices)
+        # Every level of detail holds the cell's insertions up to the first one that was below its threshold
+        if LEVELS_OF_DETAIL is not None:
+            output = output, cut_levels(rows, [threshold for threshold, _ in LEVELS_OF_DETAIL], True, input_line, OUTPUT_PRECISION)
 
-        for vertex in triangulation.all_vertices():
-            if vertex[0] > 0:
-                sys.stdout.write("v " + str(vertex[0]) + " " + str(vertex[1]) + " " + str(vertex[2]) + "\n")
+        if INSERTION_LOG is None:
+            return output
 
-        sys.stdout.write(input_line)
+        # The cell's insertions travel with its output, so the main process writes them in the same order
+        return output, encode_insertions(rows) + encode_text(input_line)
 
 
 class Processor:
     def __init__(self, dt):
         self.triangulation = dt
-        self.threads = []
 
-    def process_line(self, input_line):
-        split_line = input_line.rstrip("\n").split(" ")
+        self.writer = StreamWriter(sys.stdout.buffer)
 
-        identifier = split_line[0]
-        data = split_line[1:]
+        # Cell output is written in finalizer order rather than in the order workers finish
+        self.output = ReorderBuffer(self.writer, REORDER_BUFFER_SIZE)
 
-        if identifier == "#" or identifier == "":
+        # Every level of detail gets everything the output gets, with the cells cut at its threshold
+        self.levels_of_detail = None
+
+        if LEVELS_OF_DETAIL is not None:
+            self.levels_of_detail = LevelsOfDetail(self.output, LEVELS_OF_DETAIL, TRIANGULATION_THRESHOLD, REORDER_BUFFER_SIZE)
+            self.output = self.levels_of_detail
+
+        # The insertion log gets everything the output gets, with the cells' insertions instead of their vertices;
+        # triangles with an error of exactly the threshold are still refined
+        if INSERTION_LOG is not None:
+            self.output = InsertionLog(self.output, INSERTION_LOG, TRIANGULATION_THRESHOLD, True, REORDER_BUFFER_SIZE)
+
+        # Cells run on worker processes; threads were serialized by the GIL
+        self.pool = CellPool(self.triangulation.finalize, PROCESS_COUNT)
+
+        # Cells waiting for a free worker are queued, and spilled to disk past the memory budget, instead of blocking the input
+        self.pending = PendingCells(self.pool, PENDING_MEMORY_BUDGET, SPILL_BUDGET)
+
+        # Candidates for the corner points of every open cell, set up once the bbox and cell size are known
+        self.corner_seeds = None
+
+        # Splits dense cells before they are queued, set up together with the corner seeds
+        self.subdivider = None
+
+    def finish_cell(self, ticket, points, output):
+        # A failed cell produces no output, as before
+        self.output.complete(ticket, output)
+
+    def process_event(self, event):
+        identifier = event.identifier
+
+        if identifier == "#":
+            # endsprinkle
             pass
 
         elif identifier == "n":
             # Total number of points
-            self.triangulation.total_points = int(data[0])
-            sys.stdout.write(input_line)
+            self.triangulation.total_points = int(event.values[0])
+            self.output.write(event.text)
 
         elif identifier == "c":
             # Grid dimensions (cXc)
-            self.triangulation.initialize_grid(int(data[0]))
-            sys.stdout.write(input_line)
+            self.triangulation.initialize_grid(int(event.values[0]))
+            self.output.write(event.text)
 
         elif identifier == "s":
             # Cell size
-            self.triangulation.cell_size = int(data[0])
-            sys.stdout.write(input_line)
+            self.triangulation.cell_size = int(event.values[0])
+            self.output.write(event.text)
 
         elif identifier == "b":
             # bbox
-            self.triangulation.set_bbox(float(data[0]), float(data[1]), float(data[2]), float(data[3]))
-            sys.stdout.write(input_line)
+            self.triangulation.set_bbox(float(event.values[0]), float(event.values[1]), float(event.values[2]), float(event.values[3]))
+            self.corner_seeds = CornerSeeds(self.triangulation.min_x, self.triangulation.min_y, self.triangulation.cell_size, per_cell=True)
+            self.subdivider = CellSubdivider(self.triangulation.min_x, self.triangulation.min_y, self.triangulation.cell_size, SUBDIVISION_THRESHOLD)
+            self.output.write(event.text)
 
         elif identifier == "v":
             # vertex
-            self.triangulation.insert_point_in_grid(float(data[0]), float(data[1]), float(data[2]))
+            self.triangulation.insert_points_in_grid(event.points)
+            self.corner_seeds.add(event.points)
 
         elif identifier == "x":
             # cell finalizer
-            # self.triangulation.finalize(int(data[0]), int(data[1]), input_line)
+            points = self.triangulation.take_cell(event.grid_x, event.grid_y)
+            corner_seeds = self.corner_seeds.take(event.grid_x, event.grid_y)
+            ticket = self.output.reserve()
 
-            thread = threading.Thread(target=self.triangulation.finalize, args=(int(data[0]), int(data[1]), input_line, len(self.threads)), daemon=True)
-            self.threads.append(thread)
-            thread.start()
+            if len(points) == 0:
+                self.output.complete(ticket, event.text)
+                return
+
+            self.subdivider.submit(self.pending, event.text, event.grid_x, event.grid_y, corner_seeds, points, callback=partial(self.finish_cell, ticket))
 
         else:
             # Unknown identifier in stream
@@ -273,9 +332,15 @@ if __name__ == "__main__":
     tr = Triangulation()
     processor = Processor(tr)
 
-    for stdin_line in sys.stdin.readlines():
-        processor.process_line(stdin_line)
+    for event in read_events(sys.stdin.buffer):
+        processor.process_event(event)
+
+    processor.pending.join()
+    processor.writer.close()
+
+    if INSERTION_LOG is not None:
+        processor.output.close()
 
-    for thread in processor.threads:
-        thread.join()
+    if LEVELS_OF_DETAIL is not None:
+        processor.levels_of_detail.close()
 
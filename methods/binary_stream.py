@@ -0,0 +1,52 @@
+import struct
+
+import numpy as np
+
+# Written once at the start of a binary stream so readers can tell it apart from the sst text format
+MAGIC = b"SSTB\x01\n"
+
+# Every record is a type byte and the length of its payload, followed by the payload itself
+RECORD = struct.Struct("<cI")
+
+HEADER = b"H"
+VERTICES = b"V"
+FINALIZER = b"X"
+END_SPRINKLE = b"E"
+
+FINALIZER_PAYLOAD = struct.Struct("<ii")
+
+# Little-endian float64 x, y, z per vertex
+VERTEX_DTYPE = np.dtype("<f8")
+
+
+def encode_header(text):
+    payload = text.encode()
+
+    return RECORD.pack(HEADER, len(payload)) + payload
+
+
+def encode_vertices(points):
+    payload = np.ascontiguousarray(points, dtype=VERTEX_DTYPE).tobytes()
+
+    return RECORD.pack(VERTICES, len(payload)) + payload
+
+
+def encode_finalizer(grid_x, grid_y):
+    return RECORD.pack(FINALIZER, FINALIZER_PAYLOAD.size) + FINALIZER_PAYLOAD.pack(grid_x, grid_y)
+
+
+def encode_end_sprinkle():
+    return RECORD.pack(END_SPRINKLE, 0)
+
+
+def encode_event(event):
+    if event.identifier == "v":
+        return encode_vertices(event.points)
+
+    elif event.identifier == "x":
+        return encode_finalizer(event.grid_x, event.grid_y)
+
+    elif event.identifier == "#":
+        return encode_end_sprinkle()
+
+    return encode_header(event.text)
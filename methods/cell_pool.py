@@ -0,0 +1,221 @@
+import psutil
+import sys
+import threading
+import traceback
+
+from multiprocessing import Process, Queue, current_process
+from multiprocessing.connection import wait as wait_for
+
+from memory_scheduler import ADMISSION_INTERVAL, MemoryScheduler, available_cores, peak_rss
+
+
+def work(target, shared_args, jobs, done):
+    process = psutil.Process()
+    peak = peak_rss()
+
+    # Long-lived worker: keep taking cell jobs until the None sentinel arrives
+    while True:
+        job = jobs.get()
+
+        if job is None:
+            break
+
+        job_id, args = job
+
+        result = None
+
+        rss = process.memory_info().rss
+
+        try:
+            result = target(*args, *shared_args)
+
+        # Keep the worker alive if a single cell fails, including panics in startin that pyo3 raises as BaseException
+        except BaseException as error:
+            sys.stderr.write(current_process().name + " - FAILED:\n" + traceback.format_exc())
+            sys.stderr.flush()
+
+            # Stop the worker after all; the pool fails the cell and starts another worker
+            if isinstance(error, (KeyboardInterrupt, SystemExit)):
+                raise
+
+        # Memory the cell took on top of what the worker held before, if it raised the worker's peak
+        last_peak, peak = peak, peak_rss()
+        memory_used = peak - rss if peak > last_peak else None
+
+        # The result (the cell's output) goes back to the main process instead of being written from here
+        done.put((job_id, current_process().pid, result, memory_used))
+
+
+class CellPool:
+    def __init__(self, target, processes=None, shared_args=(), scheduler=None):
+        self.target = target
+
+        # None sizes the pool from the cores this process may use
+        self.processes = available_cores() if processes is None else max(1, processes)
+
+        # Admits cells based on their point count and the free memory
+        self.scheduler = MemoryScheduler() if scheduler is None else scheduler
+
+        # Objects such as Locks and Queues can only reach a worker through inheritance, not through the job queue
+        self.shared_args = shared_args
+
+        self.done = Queue()
+
+        # pid -> (Process, its own job queue); every job goes to one known worker, so a worker that dies takes only
+        # its own job down with it
+        self.workers = {}
+
+        # pids of the workers without a job, and pid -> job_id of the ones running one
+        self.idle = []
+        self.assigned = {}
+
+        self.collector = None
+        self.closing = False
+
+        self.next_job_id = 0
+        self.running = 0
+        self.callbacks = {}
+        self.point_counts = {}
+
+        self.condition = threading.Condition()
+
+    def start(self):
+        if self.workers:
+            return
+
+        for _ in range(self.processes):
+            self.start_worker()
+
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def start_worker(self):
+        jobs = Queue()
+
+        worker = Process(target=work, args=(self.target, self.shared_args, jobs, self.done,), daemon=True)
+        worker.start()
+
+        self.workers[worker.pid] = (worker, jobs)
+        self.idle.append(worker.pid)
+
+    def collect(self):
+        # Wake up on every finished cell, and on every worker that exits, instead of polling the workers
+        while True:
+            with self.condition:
+                sentinels = {worker.sentinel: pid for pid, (worker, _) in self.workers.items()}
+
+            ready = wait_for([self.done._reader] + list(sentinels))
+
+            # Results come first; a worker may have sent its last one just before it died
+            if self.done._reader in ready:
+                message = self.done.get()
+
+                if message is None:
+                    break
+
+                job_id, pid, result, memory_used = message
+
+                self.finish(job_id, pid, result, memory_used)
+                continue
+
+            for sentinel in ready:
+                self.lost(sentinels[sentinel])
+
+    def finish(self, job_id, pid, result, memory_used):
+        with self.condition:
+            # A job whose worker was already given up on is done
+            if job_id not in self.point_counts:
+                return
+
+            callback = self.callbacks.pop(job_id, None)
+
+            self.scheduler.finish(job_id, self.point_counts.pop(job_id), memory_used)
+
+            if self.assigned.get(pid) == job_id:
+                del self.assigned[pid]
+                self.idle.append(pid)
+
+        if callback is not None:
+            callback(result)
+
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    def lost(self, pid):
+        # A worker exited: after the None sentinel, or killed (out of memory, a segfault) in the middle of a cell
+        with self.condition:
+            worker, _ = self.workers.pop(pid)
+            worker.join()
+
+            job_id = self.assigned.pop(pid, None)
+
+            if pid in self.idle:
+                self.idle.remove(pid)
+
+            if not self.closing:
+                sys.stderr.write("Worker {} exited with code {}, starting another\n".format(pid, worker.exitcode))
+                sys.stderr.flush()
+
+                self.start_worker()
+
+            self.condition.notify_all()
+
+        # The cell it was running fails, like a crashing per-cell Process did, so its callers still see it finish
+        if job_id is not None:
+            self.finish(job_id, pid, None, None)
+
+    def submit(self, *args, callback=None, point_count=0):
+        # Workers are started lazily so they inherit the header (bbox, cell size) read before the first cell
+        self.start()
+
+        with self.condition:
+            while self.running >= self.processes or not self.idle:
+                self.condition.wait()
+
+            # A dense cell waits for running cells to finish when it is not expected to fit in the free memory
+            while not self.scheduler.can_admit(point_count):
+                self.condition.wait(ADMISSION_INTERVAL)
+
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            self.running += 1
+
+            self.scheduler.admit(job_id, point_count)
+            self.point_counts[job_id] = point_count
+
+            if callback is not None:
+                self.callbacks[job_id] = callback
+
+            pid = self.idle.pop()
+            self.assigned[pid] = job_id
+
+            _, jobs = self.workers[pid]
+
+        jobs.put((job_id, args))
+
+    def wait(self):
+        # Block until every submitted job has finished and its callback has run
+        with self.condition:
+            while self.running > 0:
+                self.condition.wait()
+
+    def join(self):
+        if not self.workers:
+            return
+
+        self.wait()
+
+        with self.condition:
+            self.closing = True
+
+            workers = list(self.workers.values())
+
+        for _, jobs in workers:
+            jobs.put(None)
+
+        for worker, _ in workers:
+            worker.join()
+
+        self.done.put(None)
+        self.collector.join()
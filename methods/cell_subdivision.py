@@ -0,0 +1,170 @@
+import numpy as np
+
+from functools import partial
+
+from corner_seeds import CORNER_OFFSET, SEED_COUNT, nearest_z_values
+from insertion_log import encode_text
+
+# Deepest level of the quadtree; a cell is split into at most 4 ** MAX_DEPTH sub-cells
+MAX_DEPTH = 4
+
+
+class SubdividedCell:
+    def __init__(self, input_line, points, part_count, callback):
+        self.input_line = input_line
+        self.points = points
+
+        # Output of every sub-cell, merged in sub-cell order once the last one is done
+        self.outputs = [None] * part_count
+        self.remaining = part_count
+        self.failed = False
+
+        self.callback = callback
+
+    def complete(self, index, points, output):
+        # Called from the pool's collector thread, one sub-cell at a time
+        self.outputs[index] = output
+        self.failed = self.failed or output is None
+        self.remaining -= 1
+
+        if self.remaining > 0:
+            return
+
+        merged = None
+
+        # A failed sub-cell fails the whole cell, as if it had not been split
+        if not self.failed:
+            merged = self.merge(self.outputs)
+
+        self.callback(self.points, merged)
+
+    def merge(self, outputs):
+        if isinstance(outputs[0], str):
+            return self.merge_text(outputs)
+
+        inner_outputs, extras = zip(*outputs)
+
+        # With an insertion log, sub-cells return their output together with their log records
+        if isinstance(extras[0], bytes):
+            return self.merge(inner_outputs), b"".join(extras) + encode_text(self.input_line)
+
+        # With levels of detail, together with their block of every level
+        return self.merge(inner_outputs), tuple(self.merge_text(level_outputs) for level_outputs in zip(*extras))
+
+    def merge_text(self, outputs):
+        # Seeds on a shared boundary are written by every sub-cell around them but only needed once
+        lines = "".join(outputs).splitlines(keepends=True)
+
+        return "".join(dict.fromkeys(lines)) + self.input_line
+
+
+class CellSubdivider:
+    def __init__(self, min_x, min_y, cell_size, max_points, point_buffer=None):
+        self.min_x = min_x
+        self.min_y = min_y
+        self.cell_size = cell_size
+
+        # None never splits a cell
+        self.max_points = max_points
+
+        # PointBuffer or SharedPointArena the cells are taken from; None when they are plain arrays
+        self.point_buffer = point_buffer
+
+    def submit(self, pending, input_line, grid_x, grid_y, corner_seeds, points, callback):
+        # Hands a cell to the pending queue like pending.submit, split into sub-cells first when it is too dense
+        if self.max_points is None or len(points) <= self.max_points:
+            pending.submit(input_line, grid_x, grid_y, corner_seeds, points, callback=callback)
+            return
+
+        # Read in place; the sub-cells get copies of their points, so nothing refers to the cell's block afterwards
+        cell_points = points if self.point_buffer is None else self.point_buffer.view(points)
+
+        parts = self.split(grid_x, grid_y, corner_seeds, cell_points)
+
+        cell = SubdividedCell(input_line, points, len(parts), callback)
+
+        # Sub-cells are refined in parallel, each as a cell of its own without a finalizer line
+        for index, (seeds, part_points) in enumerate(parts):
+            pending.submit("", grid_x, grid_y, seeds, part_points, callback=partial(cell.complete, index))
+
+    def node_coordinate(self, low, node, side):
+        # The far side of the cell is placed just inside it, like the cell corners
+        if node == side:
+            return low + self.cell_size - CORNER_OFFSET
+
+        return low + self.cell_size * node / side
+
+    def split(self, grid_x, grid_y, corner_seeds, points):
+        # Returns [(seeds, points)] for the non-empty leaves of a quadtree over the cell
+        side = 1 << MAX_DEPTH
+
+        low_x = self.min_x + (self.cell_size * grid_x)
+        low_y = self.min_y + (self.cell_size * grid_y)
+
+        # Position of every point on the finest level of the quadtree; stray points go to the nearest sub-cell
+        cells = np.floor((points[:, :2] - [low_x, low_y]) / self.cell_size * side).astype(np.int64)
+        cells = np.clip(cells, 0, side - 1)
+
+        # Leaves as (x, y, size, point indexes) in nodes of the finest level, in Z order
+        leaves = []
+        stack = [(0, 0, side, np.arange(len(points)))]
+
+        while stack:
+            x, y, size, indexes = stack.pop()
+
+            if len(indexes) <= self.max_points or size == 1:
+                leaves.append((x, y, size, indexes))
+                continue
+
+            half = size // 2
+
+            right = cells[indexes, 0] >= x + half
+            top = cells[indexes, 1] >= y + half
+
+            stack.append((x + half, y + half, half, indexes[right & top]))
+            stack.append((x, y + half, half, indexes[~right & top]))
+            stack.append((x + half, y, half, indexes[right & ~top]))
+            stack.append((x, y, half, indexes[~right & ~top]))
+
+        nodes = np.array(sorted(set((x + dx, y + dy) for x, y, size, _ in leaves for dx in (0, size) for dy in (0, size))))
+
+        bounds = np.array([(x, y, x + size, y + size) for x, y, size, _ in leaves])
+
+        # The corners of the cell keep the seeds of the undivided cell; all other nodes get the nearest points of the
+        # leaves around them, once, so every sub-cell sharing a node gets the very same seed
+        cell_corners = dict(zip([(0, 0), (side, 0), (0, side), (side, side)], corner_seeds))
+
+        seeds = {}
+
+        for node_x, node_y in nodes.tolist():
+            x, y, z_values = cell_corners.get((node_x, node_y), (self.node_coordinate(low_x, node_x, side), self.node_coordinate(low_y, node_y, side), None))
+
+            if z_values is None:
+                around = (bounds[:, 0] <= node_x) & (node_x <= bounds[:, 2]) & (bounds[:, 1] <= node_y) & (node_y <= bounds[:, 3])
+                around_points = points[np.concatenate([leaves[leaf][3] for leaf in np.flatnonzero(around)])]
+
+                # Nodes between nearly empty sub-cells look at the whole cell instead
+                if len(around_points) < SEED_COUNT:
+                    around_points = points
+
+                (x, y, z_values), = nearest_z_values([[x, y, None]], around_points)
+
+            seeds[(node_x, node_y)] = [x, y, z_values]
+
+        parts = []
+
+        for x, y, size, indexes in leaves:
+            if len(indexes) == 0:
+                continue
+
+            # The four corners of the sub-cell first, then the corners of smaller neighbours along its sides
+            corners = [(x, y), (x + size, y), (x, y + size), (x + size, y + size)]
+
+            on_boundary = ((nodes[:, 0] == x) | (nodes[:, 0] == x + size)) & (y <= nodes[:, 1]) & (nodes[:, 1] <= y + size)
+            on_boundary |= ((nodes[:, 1] == y) | (nodes[:, 1] == y + size)) & (x <= nodes[:, 0]) & (nodes[:, 0] <= x + size)
+
+            sides = [node for node in map(tuple, nodes[on_boundary].tolist()) if node not in corners]
+
+            parts.append(([seeds[node] for node in corners + sides], points[indexes]))
+
+        return parts
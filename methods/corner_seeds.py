@@ -0,0 +1,145 @@
+import numpy as np
+
+# Nearest points averaged into the z value of a cell corner
+SEED_COUNT = 10
+
+# Radius of the window around each grid corner whose points are kept as seed candidates, as a share of the cell size
+SEED_RADIUS = 0.1
+
+# Candidates kept per corner; past this the farthest are dropped and the window shrinks accordingly
+SEED_CANDIDATES = 2 * SEED_COUNT
+
+# The far corners of a cell are placed just inside it
+CORNER_OFFSET = 1E-5
+
+
+def cell_corners(min_x, min_y, cell_size, grid_x, grid_y):
+    x = min_x + (cell_size * grid_x)
+    y = min_y + (cell_size * grid_y)
+
+    return [
+        [x, y],
+        [x + cell_size - CORNER_OFFSET, y],
+        [x, y + cell_size - CORNER_OFFSET],
+        [x + cell_size - CORNER_OFFSET, y + cell_size - CORNER_OFFSET]
+    ]
+
+
+def nearest_z_values(seeds, points):
+    # Completes the seeds of a cell in the worker: corners without enough candidates get the z values of the nearest
+    # points of the whole cell, as the KD-tree query used to; returns [(x, y, z values by distance)]
+    completed = []
+
+    for x, y, z_values in seeds:
+        if z_values is None:
+            distances = np.hypot(points[:, 0] - x, points[:, 1] - y)
+
+            nearest = np.argpartition(distances, SEED_COUNT)[:SEED_COUNT] if len(points) > SEED_COUNT else np.arange(len(points))
+            nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+
+            z_values = points[nearest, 2]
+
+        completed.append((x, y, z_values))
+
+    return completed
+
+
+class CornerSeeds:
+    def __init__(self, min_x, min_y, cell_size, per_cell=False):
+        self.min_x = min_x
+        self.min_y = min_y
+        self.cell_size = cell_size
+
+        self.low = np.array([min_x, min_y])
+        self.radius = SEED_RADIUS * cell_size
+
+        # Cell-based methods only seed a cell with its own points, the others with everything since the last finalizer
+        self.per_cell = per_cell
+
+        # Grid corner (prefixed with the cell when per_cell) -> candidate points, their distances to the grid corner and
+        # the distance below which no point is missing from the candidates
+        self.candidates = {}
+
+    def add(self, points):
+        # Every point is only compared with the grid corner nearest to it, for a whole batch at once
+        offsets = (points[:, :2] - self.low) / self.cell_size
+        corners = np.rint(offsets)
+
+        distances = np.hypot(offsets[:, 0] - corners[:, 0], offsets[:, 1] - corners[:, 1]) * self.cell_size
+        near = distances < self.radius
+
+        if not near.any():
+            return
+
+        points = points[near]
+        distances = distances[near]
+
+        keys = corners[near].astype(np.int64)
+
+        if self.per_cell:
+            keys = np.c_[np.floor(offsets[near]).astype(np.int64), keys]
+
+        unique_keys, key_indexes = np.unique(keys, axis=0, return_inverse=True)
+        key_indexes = key_indexes.ravel()
+
+        order = np.argsort(key_indexes, kind="stable")
+        groups = np.split(order, np.searchsorted(key_indexes[order], np.arange(1, len(unique_keys))))
+
+        for key, indexes in zip(unique_keys.tolist(), groups):
+            self.merge(tuple(key), points[indexes], distances[indexes])
+
+    def merge(self, key, points, distances):
+        bound = self.radius
+
+        if key in self.candidates:
+            old_points, old_distances, bound = self.candidates[key]
+
+            points = np.concatenate((old_points, points))
+            distances = np.concatenate((old_distances, distances))
+
+        if len(points) > SEED_CANDIDATES:
+            order = np.argsort(distances, kind="stable")
+
+            # Whatever gets dropped is no closer than the first dropped candidate
+            bound = min(bound, distances[order[SEED_CANDIDATES]])
+
+            keep = np.sort(order[:SEED_CANDIDATES])
+
+            points = points[keep]
+            distances = distances[keep]
+
+        self.candidates[key] = (points, distances, bound)
+
+    def take(self, grid_x, grid_y):
+        # Returns [x, y, z values] for the four corners of the cell, with None for the z values of a corner that has
+        # too few points near it; these are looked up in the worker by nearest_z_values
+        grid_corners = [(grid_x, grid_y), (grid_x + 1, grid_y), (grid_x, grid_y + 1), (grid_x + 1, grid_y + 1)]
+
+        seeds = []
+
+        for (x, y), grid_corner in zip(cell_corners(self.min_x, self.min_y, self.cell_size, grid_x, grid_y), grid_corners):
+            key = (grid_x, grid_y) + grid_corner if self.per_cell else grid_corner
+
+            seeds.append([x, y, self.nearest(x, y, self.candidates.pop(key, None))])
+
+        # Everything else since the last finalizer belongs to no later cell
+        if not self.per_cell:
+            self.candidates = {}
+
+        return seeds
+
+    def nearest(self, x, y, entry):
+        if entry is None:
+            return None
+
+        points, _, bound = entry
+
+        distances = np.hypot(points[:, 0] - x, points[:, 1] - y)
+        nearest = np.argsort(distances, kind="stable")[:SEED_COUNT]
+
+        # Points that are no candidates are at least bound from the grid corner, and the corner moved by less than
+        # 2 * CORNER_OFFSET; only then are these certainly the nearest points
+        if len(nearest) < SEED_COUNT or distances[nearest[-1]] >= bound - 2 * CORNER_OFFSET:
+            return None
+
+        return points[nearest, 2]
@@ -2,16 +2,100 @@ import os
 import sys
 import time
 
+import numpy as np
 import psutil
 import startinpy
 
-from heapq import heappop, heapify
-from ast import literal_eval
+from math import ceil, sqrt
+
+from cell_pool import CellPool
+from stream_parser import read_star_records
+from versioned_heap import VersionedHeap
 
 TRIANGULATION_THRESHOLD = 0.2
 PROCESSING_THRESHOLD = 100000
 
-INTERVAL = 100
+# Number of worker processes decimating independent regions of a round; 1 decimates everything in this process, in the
+# same order as before, None uses all cores not taken by sstfin and sstdt. Regions remove vertices in a different order,
+# so their output differs from the serial one
+PROCESS_COUNT = 1
+
+# Approximate number of candidate vertices per region handed to a worker
+REGION_VERTICES = 20000
+
+
+def calculate_delta(triangulation, vertex_id):
+    vertex = triangulation.get_point(vertex_id)
+
+    triangulation.remove(vertex_id)
+    end_value = triangulation.interpolate_tin_linear(vertex[0], vertex[1])
+
+    triangulation.insert_one_pt(vertex[0], vertex[1], vertex[2], vertex_id)
+
+    return abs(end_value - vertex[2])
+
+
+def decimate(triangulation, heap):
+    # Removes the vertex with the smallest delta while it is below the threshold; returns the removed ids in order
+    removed = []
+
+    while heap:
+        delta, vertex_id = heap.peek()
+
+        # Deltas in the heap are always up to date, so once the smallest one reaches the threshold we're done;
+        # the rest stays in the heap for the next round
+        if delta >= TRIANGULATION_THRESHOLD:
+            break
+
+        heap.pop()
+
+        # Only the stars of the neighbours change when a vertex is removed
+        neighbours = triangulation.adjacent_vertices_to_vertex(vertex_id)
+
+        triangulation.remove(vertex_id)
+        removed.append(vertex_id)
+
+        for neighbour_id in neighbours:
+            # Written stars, the infinite vertex and vertices that were never candidates are not in the heap
+            if neighbour_id not in heap:
+                continue
+
+            if triangulation.can_vertex_be_removed(neighbour_id):
+                heap.push(neighbour_id, calculate_delta(triangulation, neighbour_id))
+            else:
+                heap.discard(neighbour_id)
+
+    return removed
+
+
+def decimate_region(vertex_ids, coordinates, region_ids, region_deltas):
+    # Runs in a worker: the region with the ring of vertices around it is triangulated on its own, which gives the
+    # region's vertices exactly the stars they have in the full triangulation
+    triangulation = startinpy.DT()
+
+    local_ids = {}
+
+    for vertex_id, (x, y, z) in zip(vertex_ids, coordinates.tolist()):
+        local_ids[vertex_id] = triangulation.insert_one_pt(x, y, z, 0)
+
+    global_ids = {local_id: vertex_id for vertex_id, local_id in local_ids.items()}
+
+    heap = VersionedHeap()
+
+    # The main process already has the deltas of the region's vertices; their stars are the same here
+    for vertex_id, delta in zip(region_ids, region_deltas):
+        heap.push(local_ids[vertex_id], delta)
+
+    removed = decimate(triangulation, heap)
+
+    # The deltas of the vertices that are left are up to date for the merged triangulation as well
+    deltas = {}
+
+    while heap:
+        delta, local_id = heap.pop()
+        deltas[global_ids[local_id]] = delta
+
+    return [global_ids[local_id] for local_id in removed], deltas
 
 
 class Triangulation:
@@ -32,6 +116,16 @@ class Triangulation:
 
         self.finalized = {}
 
+        # Unwritten vertex ids by delta, kept between rounds; a removal replaces the entries of its neighbours
+        self.heap = VersionedHeap()
+
+        # Vertices whose delta may have changed since the last round: newly finalized stars and the ring around them
+        self.new_stars = []
+        self.changed = set()
+
+        # Workers decimating independent regions of a round; started at the first round big enough to split up
+        self.pool = CellPool(decimate_region, PROCESS_COUNT)
+
         self.memory_log_file = open(os.path.join(os.getcwd(), "memlog_decimation.csv"), "a")
 
     def set_bbox(self, min_x, min_y, max_x, max_y):
@@ -47,65 +141,131 @@ class Triangulation:
         self.vertex_id += 1
 
     def calculate_delta(self, vertex_id):
-        vertex = self.triangulation.get_point(vertex_id)
+        return calculate_delta(self.triangulation, vertex_id)
 
-        self.triangulation.remove(vertex_id)
-        end_value = self.triangulation.interpolate_tin_linear(vertex[0], vertex[1])
+    def decimate_regions(self, candidates):
+        # candidates: the vertices evaluated this round; every other delta in the heap was at least the threshold after
+        # the last round and can only change through a removal next to it
+        heap = self.heap
 
-        self.triangulation.insert_one_pt(vertex[0], vertex[1], vertex[2], vertex_id)
+        # Square tiles over the candidates, each holding about REGION_VERTICES of them
+        tiles_per_side = ceil(sqrt(len(candidates) / REGION_VERTICES))
 
-        return abs(end_value - vertex[2])
+        if tiles_per_side < 2:
+            return 0
 
-    def simplify_triangulation(self, finalize=False):
+        coordinates = np.array([self.triangulation.get_point(vertex_id) for vertex_id in candidates])
 
-        did_something = False
+        low = coordinates[:, :2].min(axis=0)
+        tile_size = (coordinates[:, :2].max(axis=0) - low) / tiles_per_side + 1E-9
 
-        self.memory_log_file.write("Main, " + str(round(time.time())) + ", " + str(psutil.Process(os.getpid()).memory_info().rss) + "\n")
+        tile_indexes = np.floor((coordinates[:, :2] - low) / tile_size).astype(np.int64)
+        tiles = dict(zip(candidates, (tile_indexes[:, 0] * tiles_per_side + tile_indexes[:, 1]).tolist()))
 
-        heap = []
+        neighbours = {vertex_id: self.triangulation.adjacent_vertices_to_vertex(vertex_id) for vertex_id in candidates}
 
-        # Only get stars that have not yet been written
-        for vertex_id in self.triangulation.all_vertex_ids_written(False):
-            # Not infinite vertex or vertex on CH or vertex previously removed
-            if not self.triangulation.can_vertex_be_removed(vertex_id):
-                continue
+        regions = {}
+
+        for vertex_id in candidates:
+            tile = tiles[vertex_id]
+
+            # Vertices next to a candidate of another tile form the frozen boundary; no edge joins two regions, so
+            # their removals don't affect each other
+            if all(tiles.get(neighbour_id, tile) == tile for neighbour_id in neighbours[vertex_id]):
+                regions.setdefault(tile, []).append(vertex_id)
+
+        results = []
+
+        for region_ids in regions.values():
+            # The region plus the ring around it; the infinite vertex is never part of a region's stars
+            vertex_ids = sorted(set(region_ids).union(*(neighbours[vertex_id] for vertex_id in region_ids)) - {0})
+            region_coordinates = np.array([self.triangulation.get_point(vertex_id) for vertex_id in vertex_ids])
+
+            region_deltas = [heap.priority(vertex_id) for vertex_id in region_ids]
+
+            self.pool.submit(vertex_ids, region_coordinates, region_ids, region_deltas, callback=results.append, point_count=len(vertex_ids))
+
+        self.pool.wait()
 
-            heap.append((self.calculate_delta(vertex_id), vertex_id))
+        removed_count = 0
 
-        sys.stderr.write("Size of heap: {}\n".format(len(heap)))
+        # Neighbours of removed vertices, and vertices whose delta a worker already brought up to date
+        touched = set()
+        updated = set()
+
+        # Merge back: removals of different regions are independent, only their order within a region matters
+        for removed, deltas in results:
+            for vertex_id in removed:
+                touched.update(self.triangulation.adjacent_vertices_to_vertex(vertex_id))
+
+                self.triangulation.remove(vertex_id)
+                heap.discard(vertex_id)
+
+            for vertex_id, delta in deltas.items():
+                heap.push(vertex_id, delta)
+
+            updated.update(deltas)
+            removed_count += len(removed)
+
+        # Frozen vertices next to a removed vertex got a new star
+        for vertex_id in touched - updated:
+            if vertex_id in heap:
+                if self.triangulation.can_vertex_be_removed(vertex_id):
+                    heap.push(vertex_id, self.calculate_delta(vertex_id))
+                else:
+                    heap.discard(vertex_id)
+
+        sys.stderr.write("Regions: {}, removed in parallel: {}\n".format(len(regions), removed_count))
         sys.stderr.flush()
 
-        heapify(heap)
+        return removed_count
 
-        remove_count = 0
-        removes_this_loop = 0
+    def simplify_triangulation(self, finalize=False):
+        self.memory_log_file.write("Main, " + str(round(time.time())) + ", " + str(psutil.Process(os.getpid()).memory_info().rss) + "\n")
 
-        while heap:
-            smallest_delta_vertex = heappop(heap)
+        heap = self.heap
 
-            # Get latest delta for this point
-            delta = smallest_delta_vertex[0]
+        # Only get stars that have not yet been written
+        unwritten = set(self.triangulation.all_vertex_ids_written(False))
+
+        # Stars written in the previous round are final
+        for vertex_id in heap.keys():
+            if vertex_id not in unwritten:
+                heap.discard(vertex_id)
+
+        # Earlier removals may have given the new stars other neighbours than the ones they were streamed with
+        for vertex_id in self.new_stars:
+            if vertex_id in unwritten and self.triangulation.can_vertex_be_removed(vertex_id):
+                self.changed.update(self.triangulation.adjacent_vertices_to_vertex(vertex_id))
 
-            # If delta is still below threshold, throw it out
-            if delta < TRIANGULATION_THRESHOLD:
-                remove_count += 1
-                removes_this_loop += 1
-                self.triangulation.remove(smallest_delta_vertex[1])
-                did_something = True
+        # Deltas of the other unwritten vertices are still valid; only the new part of the stream needs evaluating
+        for vertex_id in self.changed:
+            # Not infinite vertex or vertex on CH or vertex previously removed
+            if vertex_id in unwritten and self.triangulation.can_vertex_be_removed(vertex_id):
+                heap.push(vertex_id, self.calculate_delta(vertex_id))
             else:
-                break
+                heap.discard(vertex_id)
 
-            if removes_this_loop % INTERVAL == 0:
-                sys.stderr.write("Recalculating heap\n")
-                sys.stderr.flush()
+        sys.stderr.write("Size of heap: {}, evaluated: {}\n".format(len(heap), len(self.changed)))
+        sys.stderr.flush()
+
+        evaluated = [vertex_id for vertex_id in self.changed if vertex_id in heap]
+
+        self.new_stars = []
+        self.changed = set()
+
+        remove_count = 0
 
-                removes_this_loop = 0
+        if self.pool.processes > 1:
+            remove_count += self.decimate_regions(evaluated)
 
-                for vertex_id in range(len(heap)):
-                    if self.triangulation.can_vertex_be_removed(vertex_id):
-                        heap[vertex_id] = (self.calculate_delta(vertex_id), vertex_id)
+        # Whatever the regions left: their frozen boundaries, or everything when decimating in this process
+        remove_count += len(decimate(self.triangulation, heap))
 
-                heapify(heap)
+        did_something = remove_count > 0
+
+        sys.stderr.write("Removed vertices: {}\n".format(remove_count))
+        sys.stderr.flush()
 
         if did_something:
             self.triangulation.write_stars_obj(finalize)
@@ -114,6 +274,11 @@ class Triangulation:
         if neighbors:
             self.triangulation.define_star(index, neighbors)
 
+        self.new_stars.append(index)
+
+        self.changed.add(index)
+        self.changed.update(neighbors)
+
         if self.vertex_id / self.processing_id >= PROCESSING_THRESHOLD:
             self.simplify_triangulation()
             self.processing_id += 1
@@ -130,6 +295,11 @@ class Processor:
     def simplify(self):
         self._triangulation.simplify_triangulation()
 
+    def process_stars(self, stars):
+        # vertex finalizers, parsed a whole run at a time
+        for index, neighbors in zip(stars.indexes, stars.neighbors):
+            self._triangulation.new_star(index, neighbors)
+
     def process_line(self, input_line):
         split_line = input_line.rstrip("\n").split(" ")
 
@@ -151,10 +321,6 @@ class Processor:
             # face
             pass
 
-        elif identifier == "x":
-            # vertex finalizer
-            self._triangulation.new_star(int(data[0]), literal_eval("".join(data[1:])))
-
         else:
             # Unknown identifier in stream
             pass
@@ -166,12 +332,17 @@ if __name__ == "__main__":
 
     start_time = time.time()
 
-    for stdin_line in sys.stdin:
-        processor.process_line(stdin_line)
+    for record in read_star_records(sys.stdin.buffer):
+        if isinstance(record, str):
+            processor.process_line(record)
+        else:
+            processor.process_stars(record)
 
     # Finalize remaining points
     triangulation.simplify_triangulation(finalize=True)
 
+    triangulation.pool.join()
+
     triangulation.memory_log_file.write("Main, " + str(round(time.time())) + ", " + str(psutil.Process(os.getpid()).memory_info().rss) + "\n")
 
     triangulation.memory_log_file.flush()
@@ -7,15 +7,51 @@ import startinpy
 
 import numpy as np
 
+from functools import partial
 from heapq import heapify, heappop
-from multiprocessing import cpu_count, Process, Lock, Queue, current_process
-from scipy.spatial import KDTree
+from multiprocessing import Process, Queue, current_process
+
+from cell_pool import CellPool
+from cell_subdivision import CellSubdivider
+from corner_seeds import CornerSeeds, nearest_z_values
+from pending_cells import PendingCells
+from point_buffer import PointBuffer, as_array
+from point_order import point_order
+from reorder_buffer import ReorderBuffer
+from shared_points import SharedPointArena
+from stream_parser import read_events
+from stream_writer import StreamWriter
+from vertex_format import format_vertices
 
 COARSE_THRESHOLD = 2
 FINE_THRESHOLD = 0.2
 
 RECALCULATION_INTERVAL = 10
 
+# Digits after the decimal point of output vertices; None writes them exactly like str(float)
+OUTPUT_PRECISION = None
+
+# Hand cells to workers through shared memory instead of pickling their points
+USE_SHARED_MEMORY = False
+
+# Bytes of finished cells held back to keep the output in stream order; 0 writes cells as soon as they finish
+REORDER_BUFFER_SIZE = 1 << 28
+
+# Bytes of points of cells waiting for a worker kept in memory, and spilled to disk after that, before input is paused
+PENDING_MEMORY_BUDGET = 1 << 30
+SPILL_BUDGET = 1 << 36
+
+# Number of long-lived worker processes finalizing cells; None uses all cores not taken by sstfin and sstdt
+PROCESS_COUNT = None
+
+# Cells with more points than this are split into quadtree sub-cells that are refined in parallel, seeded with shared
+# points on their common boundaries and written back as one cell; None never splits a cell
+SUBDIVISION_THRESHOLD = None
+
+# Order of the points in the coarse and fine loops: None keeps the stream order, "hilbert" sorts them along a Hilbert
+# curve and "brio" inserts them in randomized rounds that are each sorted along the curve
+INSERTION_ORDER = None
+
 
 class MemoryUsage:
     def __init__(self, process_name, timestamp, memory_usage):
@@ -39,73 +75,48 @@ class Triangulation:
         self.max_x = max_x
         self.max_y = max_y
 
-    def finalize(self, input_line, grid_x, grid_y, vertices, lock, memory_usage_queue):
+    def finalize(self, input_line, grid_x, grid_y, corner_seeds, vertices, memory_usage_queue):
         stdout_lines = []
-        if len(vertices) > 0:
-
-            triangulation = startinpy.DT()
 
-            x_vals = []
-            y_vals = []
-            z_vals = []
+        vertices = as_array(vertices)
 
-            for vertex_id, point in vertices.items():
-                x_vals.append(point[0])
-                y_vals.append(point[1])
-                z_vals.append(point[2])
-
-            tree = KDTree(np.c_[x_vals, y_vals])
+        if len(vertices) > 0:
 
-            corner_points = [
-                [self.min_x + (self.cell_size * grid_x), self.min_y + (self.cell_size * grid_y)],
-                [self.min_x + (self.cell_size * grid_x) + self.cell_size - 1E-5, self.min_y + (self.cell_size * grid_y)],
-                [self.min_x + (self.cell_size * grid_x), self.min_y + (self.cell_size * grid_y) + self.cell_size - 1E-5],
-                [self.min_x + (self.cell_size * grid_x) + self.cell_size - 1E-5, self.min_y + (self.cell_size * grid_y) + self.cell_size - 1E-5]
-            ]
+            triangulation = startinpy.DT()
 
             near_corner_points = []
 
-            for corner_point in corner_points:
-                # Get nearest point to corner
-                distances, indexes = tree.query(corner_point, k=10)
-
-                queried_z_vals = [z_vals[index] for index in indexes if index < len(z_vals)]
-
+            # Points near the corners were picked out while the cell was read; only sparse corners need the whole cell
+            for x, y, queried_z_vals in nearest_z_values(corner_seeds, vertices):
                 # add a corner point with average z value of 10 nearest
-                near_corner_points.append([corner_point[0], corner_point[1], sum(queried_z_vals) / len(queried_z_vals)])
+                near_corner_points.append([x, y, queried_z_vals.mean()])
 
             triangulation.insert(near_corner_points)
 
-            to_delete = []
+            # Consecutive points close together keep the point location walks in startinpy short
+            if INSERTION_ORDER is not None:
+                vertices = vertices[point_order(vertices, INSERTION_ORDER)]
 
-            # First coarse loop
+            inserted = np.zeros(len(vertices), dtype=bool)
 
-            for key, vertex in vertices.items():
-                x = vertex[0]
-                y = vertex[1]
-                z = vertex[2]
+            # First coarse loop
 
+            for index, (x, y, z) in enumerate(vertices.tolist()):
                 try:
                     interpolated_value = triangulation.interpolate_tin_linear(x, y)
 
                     if abs(interpolated_value - z) > COARSE_THRESHOLD:
                         triangulation.insert_one_pt(x, y, z, 0)
-                        to_delete.append(key)
+                        inserted[index] = True
 
                 # In rare cases we get a point outside CH due to ----00.0 being counted as wrong cell
                 # FIXME: Adjust get_cell function to return correct cell for ----00.0 points
                 except OSError:
                     pass
 
-            for key in reversed(to_delete):
-                del vertices[key]
-
             # Fine loop
 
-            for key, vertex in vertices.items():
-                x = vertex[0]
-                y = vertex[1]
-                z = vertex[2]
+            for x, y, z in vertices[~inserted].tolist():
 
                 try:
                     interpolated_value = triangulation.interpolate_tin_linear(x, y)
@@ -196,37 +207,39 @@ class Triangulation:
                     heapify(heap)
 
 
-            if triangulation.number_of_vertices() > 4:
-                for i in [1, 2, 3, 4]:
-                    triangulation.remove(i)
+            # Leave out the initial corners (unless nothing else was inserted) and the infinite vertex
+            corner_ids = range(1, len(near_corner_points) + 1) if triangulation.number_of_vertices() > len(near_corner_points) else []
 
-            for vertex in triangulation.all_vertices():
-                # Don't print infinite vertex
-                if vertex[0] > 0:
-                    stdout_lines.append("v " + str(vertex[0]) + " " + str(vertex[1]) + " " + str(vertex[2]) + "\n")
+            stdout_lines.append(format_vertices(triangulation.all_vertices(), corner_ids, OUTPUT_PRECISION))
 
         memory_usage_queue.put(MemoryUsage(current_process().name, round(time.time()), psutil.Process(os.getpid()).memory_info().rss))
 
         stdout_lines.append(input_line)
 
-        with lock:
-            sys.stdout.write("".join(stdout_lines))
-            sys.stdout.flush()
+        return "".join(stdout_lines)
 
 
 class Processor:
     def __init__(self, dt):
         self.triangulation = dt
 
-        self.vertex_id = 1
-        self.vertices = {}
+        self.points = SharedPointArena() if USE_SHARED_MEMORY else PointBuffer()
+
+        self.writer = StreamWriter(sys.stdout.buffer)
+
+        # Cell output is written in finalizer order rather than in the order workers finish
+        self.output = ReorderBuffer(self.writer, REORDER_BUFFER_SIZE)
 
         self.sprinkling = True
-        self.processes = []
+
+        # Candidates for the corner points of the cell being read, set up once the bbox and cell size are known
+        self.corner_seeds = None
+
+        # Splits dense cells before they are queued, set up together with the corner seeds
+        self.subdivider = None
 
         self.last_log_time = round(time.time())
 
-        self.stdout_lock = Lock()
         self.memory_usage_queue = Queue()
 
         self.memory_usage_queue.put(MemoryUsage("Main", self.last_log_time, psutil.Process(os.getpid()).memory_info().rss))
@@ -234,6 +247,11 @@ class Processor:
         self.memory_usage_writer = Process(target=self.write_memory_usage, args=(self.memory_usage_queue,), daemon=True)
         self.memory_usage_writer.start()
 
+        self.pool = CellPool(self.triangulation.finalize, PROCESS_COUNT, shared_args=(self.memory_usage_queue,))
+
+        # Cells waiting for a free worker are queued, and spilled to disk past the memory budget, instead of blocking the input
+        self.pending = PendingCells(self.pool, PENDING_MEMORY_BUDGET, SPILL_BUDGET)
+
     def write_memory_usage(self, memory_usage_queue):
         while True:
             with open(os.path.join(os.getcwd(), "memlog_direct_refinement.csv"), "a") as memory_log_file:
@@ -244,11 +262,14 @@ class Processor:
                 else:
                     time.sleep(0.5)
 
-    def process_line(self, input_line):
-        split_line = input_line.rstrip("\n").split(" ")
+    def finish_cell(self, ticket, points, output):
+        self.points.release(points)
 
-        identifier = split_line[0]
-        data = split_line[1:]
+        # A failed cell produces no output, as before
+        self.output.complete(ticket, output)
+
+    def process_event(self, event):
+        identifier = event.identifier
 
         current_time = round(time.time())
 
@@ -256,73 +277,63 @@ class Processor:
             self.memory_usage_queue.put(MemoryUsage("Main", current_time, psutil.Process(os.getpid()).memory_info().rss))
             self.last_log_time = current_time
 
-        if identifier == "#" or identifier == "":
-            if data[0] == "endsprinkle":
-                self.sprinkling = False
-                sys.stderr.write("Sprinkling done!\n")
-                sys.stderr.flush()
+        if identifier == "#":
+            # endsprinkle
+            self.sprinkling = False
+            sys.stderr.write("Sprinkling done!\n")
+            sys.stderr.flush()
 
         elif identifier == "n":
             # Total number of points
-            self.triangulation.total_points = int(data[0])
-            sys.stdout.write(input_line)
+            self.triangulation.total_points = int(event.values[0])
+            self.output.write(event.text)
 
         elif identifier == "c":
             # Grid dimensions (cXc)
-            sys.stdout.write(input_line)
+            self.output.write(event.text)
 
         elif identifier == "s":
             # Cell size
-            self.triangulation.cell_size = int(data[0])
-            sys.stdout.write(input_line)
+            self.triangulation.cell_size = int(event.values[0])
+            self.output.write(event.text)
 
         elif identifier == "b":
             # bbox
-            self.triangulation.set_bbox(float(data[0]), float(data[1]), float(data[2]), float(data[3]))
-            sys.stdout.write(input_line)
+            self.triangulation.set_bbox(float(event.values[0]), float(event.values[1]), float(event.values[2]), float(event.values[3]))
+            self.corner_seeds = CornerSeeds(self.triangulation.min_x, self.triangulation.min_y, self.triangulation.cell_size)
+            self.subdivider = CellSubdivider(self.triangulation.min_x, self.triangulation.min_y, self.triangulation.cell_size, SUBDIVISION_THRESHOLD, self.points)
+            self.output.write(event.text)
 
         elif identifier == "v":
             # vertex
             # All sprinkle points get passed to output directly
             if not self.sprinkling:
-                self.vertices[self.vertex_id] = [float(data[0]), float(data[1]), float(data[2])]
-                self.vertex_id += 1
+                self.points.extend(event.points)
+                self.corner_seeds.add(event.points)
 
             else:
-                sys.stdout.write(input_line)
+                self.output.write(event.text)
 
         elif identifier == "x":
             # cell finalizer
             # While sprinkling, don't bother processing since all finalized cells now are still empty anyways
             if self.sprinkling:
-                sys.stdout.write(input_line)
+                self.output.write(event.text)
                 return
 
-            sys.stderr.write("Starting new process to finalize cell: {}, {}. Processing currently running: {}\n".format(data[0], data[1], len(self.processes)))
+            sys.stderr.write("Submitting cell to worker pool: {}, {}. Cells currently running: {}, queued: {}\n".format(event.grid_x, event.grid_y, self.pool.running, len(self.pending)))
             sys.stderr.flush()
 
-            sleep_time = 1
+            points = self.points.take()
+            corner_seeds = self.corner_seeds.take(event.grid_x, event.grid_y)
+            ticket = self.output.reserve()
 
-            # Ensure total number of processes never exceeds capacity
-            while len(self.processes) >= cpu_count() - 2:
-                for i in reversed(range(len(self.processes))):
-                    if not self.processes[i].is_alive():
-                        del self.processes[i]
-
-                time.sleep(sleep_time)
-
-            process = Process(target=self.triangulation.finalize, args=(input_line, int(data[0]), int(data[1]), self.vertices, self.stdout_lock, self.memory_usage_queue,), daemon=True)
-            self.vertices = {}
-            self.vertex_id = 1
-            self.processes.append(process)
-            process.start()
+            self.subdivider.submit(self.pending, event.text, event.grid_x, event.grid_y, corner_seeds, points, callback=partial(self.finish_cell, ticket))
 
         else:
             # Unknown identifier in stream
             pass
 
-        sys.stdout.flush()
-
 
 if __name__ == "__main__":
     triangulation = Triangulation()
@@ -330,10 +341,12 @@ if __name__ == "__main__":
 
     start_time = time.time()
 
-    for stdin_line in sys.stdin:
-        processor.process_line(stdin_line)
+    for event in read_events(sys.stdin.buffer):
+        processor.process_event(event)
+
+    processor.pending.join()
+    processor.writer.close()
 
-    for process in processor.processes:
-        process.join()
+    processor.points.close()
 
     sys.stderr.write("duration: " + str(time.time() - start_time) + "\n")
@@ -1,6 +1,7 @@
 import sys
 import os
 import time
+from functools import partial
 from math import floor
 
 import psutil
@@ -10,15 +11,52 @@ import startin
 import numpy as np
 
 from heapq import heappop, heapify
-from multiprocessing import cpu_count, Process, Queue, current_process, Lock
+from multiprocessing import Process, Queue, current_process
 from scipy.spatial import KDTree
 
+from cell_pool import CellPool
+from cell_subdivision import CellSubdivider
+from corner_seeds import CornerSeeds, nearest_z_values
+from pending_cells import PendingCells
+from point_buffer import PointBuffer, as_array
+from reorder_buffer import ReorderBuffer
+from shared_points import SharedPointArena
+from stream_parser import read_events
+from stream_writer import StreamWriter
+from triangle_buckets import EPSILON, barycentric
+from vertex_format import format_vertices
+from versioned_heap import VersionedHeap
+
 RECALCULATION_INTERVAL_STEP_SIZE = 1/2
 RECALCULATION_INTERVAL_UPPER_BOUNDARY = 25
 
 TRIANGULATION_THRESHOLD = 0.2
 DELTA_PRECISION = 1E4
 
+# Re-evaluate only the points around each insertion, keeping the heap exact, instead of recalculating the whole heap
+# every recalculation interval and working from stale deltas in between
+INCREMENTAL_UPDATES = True
+
+# Digits after the decimal point of output vertices; None writes them exactly like str(float)
+OUTPUT_PRECISION = None
+
+# Hand cells to workers through shared memory instead of pickling their points
+USE_SHARED_MEMORY = False
+
+# Bytes of finished cells held back to keep the output in stream order; 0 writes cells as soon as they finish
+REORDER_BUFFER_SIZE = 1 << 28
+
+# Bytes of points of cells waiting for a worker kept in memory, and spilled to disk after that, before input is paused
+PENDING_MEMORY_BUDGET = 1 << 30
+SPILL_BUDGET = 1 << 36
+
+# Number of long-lived worker processes finalizing cells; None uses all cores not taken by sstfin and sstdt
+PROCESS_COUNT = None
+
+# Cells with more points than this are split into quadtree sub-cells that are refined in parallel, seeded with shared
+# points on their common boundaries and written back as one cell; None never splits a cell
+SUBDIVISION_THRESHOLD = None
+
 
 class MemoryUsage:
     def __init__(self, process_name, timestamp, memory_usage):
@@ -28,6 +66,8 @@ class MemoryUsage:
 
 
 class Vertex:
+    __slots__ = ("x", "y", "z", "delta_z")
+
     def __init__(self, x, y, z):
         self.x = x
         self.y = y
@@ -50,59 +90,139 @@ class Triangulation:
         self.max_x = None
         self.max_y = None
 
-        self.vertices = {}
-        self.vertex_id = 1
-
     def set_bbox(self, min_x, min_y, max_x, max_y):
         self.min_x = min_x
         self.min_y = min_y
         self.max_x = max_x
         self.max_y = max_y
 
-    def insert_vertex(self, x, y, z):
-        self.vertices[self.vertex_id] = Vertex(x, y, z)
-        self.vertex_id += 1
+    def evaluate(self, triangles, vertices, points, point_indexes):
+        # Rounded deltas of the given points against the given triangles, and which points lie inside them
+        triangles = [triangle for triangle in triangles if 0 not in triangle]
+
+        corners = np.array([[vertices[vertex_id] for vertex_id in triangle] for triangle in triangles]).reshape(-1, 3, 3)
+        candidates = points[point_indexes]
+
+        weight_0, weight_1, weight_2 = barycentric(corners, candidates)
+
+        containment = np.minimum(np.minimum(weight_0, weight_1), weight_2)
+        best = containment.argmax(axis=0)
+        columns = np.arange(len(point_indexes))
+
+        inside = containment[best, columns] >= -EPSILON
+
+        interpolated = weight_0[best, columns] * corners[best, 0, 2] + weight_1[best, columns] * corners[best, 1, 2] + weight_2[best, columns] * corners[best, 2, 2]
+
+        return inside, np.round(np.abs(interpolated - candidates[:, 2]) * DELTA_PRECISION) / DELTA_PRECISION
+
+    def update_deltas(self, heap, point_indexes, deltas):
+        for point_index, delta in zip(point_indexes.tolist(), deltas.tolist()):
+            # Heap is min-based, so negate to ensure max delta is at top; points that are close enough don't need to be in it
+            if delta > TRIANGULATION_THRESHOLD:
+                heap.push(point_index, -delta)
+            else:
+                heap.discard(point_index)
+
+    def refine_incrementally(self, triangulation, points, corner_points, memory_usage_queue, last_log_time):
+        # Only the neighbourhood queries of the incremental updates need a KD-tree of the cell
+        tree = KDTree(points[:, :2])
+
+        # Coordinates of the vertices in the triangulation by vertex id; the corners get ids 1 to 4
+        vertices = dict(enumerate(corner_points, start=1))
+
+        point_indexes = np.arange(len(points))
+
+        inside, deltas = self.evaluate(triangulation.all_triangles(), vertices, points, point_indexes)
+
+        if not inside.all():
+            # If outside CH, always insert
+            for x, y, z in points[~inside].tolist():
+                vertices.setdefault(triangulation.insert_one_pt(x, y, z), (x, y, z))
+
+            point_indexes = point_indexes[inside]
+
+            inside, deltas = self.evaluate(triangulation.all_triangles(), vertices, points, point_indexes)
+
+        # Point indexes by delta; an insertion replaces the entries of the points around it, so the top is always exact
+        heap = VersionedHeap()
+
+        self.update_deltas(heap, point_indexes[inside], deltas[inside])
+
+        while heap:
+
+            current_time = round(time.time())
+
+            if current_time != last_log_time:
+                memory_usage_queue.put(MemoryUsage(current_process().name, current_time, psutil.Process(os.getpid()).memory_info().rss))
+                last_log_time = current_time
+
+            _, point_index = heap.pop()
+
+            x, y, z = points[point_index].tolist()
 
-    def finalize(self, input_line, grid_x, grid_y, vertices, lock, memory_usage_queue):
+            try:
+                vertex_id = triangulation.insert_one_pt(x, y, z)
+
+            # Somehow point is outside bbox, ignore
+            except OSError:
+                continue
+
+            vertices.setdefault(vertex_id, (x, y, z))
+
+            incident_triangles = [triangle for triangle in triangulation.incident_triangles_to_vertex(vertex_id) or [] if 0 not in triangle]
+
+            if not incident_triangles:
+                continue
+
+            # The interpolation only changed inside the new triangles around the vertex, which lie within this circle
+            ring = np.array([vertices[vertex] for triangle in incident_triangles for vertex in triangle])
+            radius = np.hypot(ring[:, 0] - x, ring[:, 1] - y).max()
+
+            neighbours = np.array(tree.query_ball_point([x, y], radius), dtype=np.int64)
+            neighbours = neighbours[neighbours != point_index]
+
+            if len(neighbours) == 0:
+                continue
+
+            inside, deltas = self.evaluate(incident_triangles, vertices, points, neighbours)
+
+            # Points that have been inserted before are no longer in the heap and fall outside the new triangles' interiors
+            self.update_deltas(heap, neighbours[inside], deltas[inside])
+
+    def finalize(self, input_line, grid_x, grid_y, corner_seeds, vertices, memory_usage_queue):
         stdout_lines = []
 
-        if len(vertices) > 0:
+        points = as_array(vertices)
+
+        if len(points) > 0:
 
             last_log_time = round(time.time())
             memory_usage_queue.put(MemoryUsage(current_process().name, last_log_time, psutil.Process(os.getpid()).memory_info().rss))
 
             triangulation = startin.DT()
 
-            x_vals = []
-            y_vals = []
-            z_vals = []
-
-            for vertex_id, vertex in vertices.items():
-                x_vals.append(vertex.x)
-                y_vals.append(vertex.y)
-                z_vals.append(vertex.z)
+            near_corner_points = []
 
-            tree = KDTree(np.c_[x_vals, y_vals])
+            # Points near the corners were picked out while the cell was read; only sparse corners need the whole cell
+            for x, y, queried_z_vals in nearest_z_values(corner_seeds, points):
+                # add a corner point with average z value of 10 nearest
+                near_corner_points.append([x, y, queried_z_vals.mean()])
 
-            corner_points = [
-                [self.min_x + (self.cell_size * grid_x), self.min_y + (self.cell_size * grid_y)],
-                [self.min_x + (self.cell_size * grid_x) + self.cell_size - 1E-5, self.min_y + (self.cell_size * grid_y)],
-                [self.min_x + (self.cell_size * grid_x), self.min_y + (self.cell_size * grid_y) + self.cell_size - 1E-5],
-                [self.min_x + (self.cell_size * grid_x) + self.cell_size - 1E-5, self.min_y + (self.cell_size * grid_y) + self.cell_size - 1E-5]
-            ]
+            triangulation.insert(near_corner_points)
 
-            near_corner_points = []
+            if INCREMENTAL_UPDATES:
+                self.refine_incrementally(triangulation, points, near_corner_points, memory_usage_queue, last_log_time)
 
-            for corner_point in corner_points:
-                # Get nearest point to corner
-                distances, indexes = tree.query(corner_point, k=10)
+                # Leave out the initial corners (unless nothing else was inserted) and the infinite vertex
+                corner_ids = range(1, len(near_corner_points) + 1) if triangulation.number_of_vertices() > len(near_corner_points) else []
 
-                queried_z_vals = [z_vals[index] for index in indexes if index < len(z_vals)]
+                stdout_lines.append(format_vertices(triangulation.all_vertices(), corner_ids, OUTPUT_PRECISION))
+                stdout_lines.append(input_line)
 
-                # add a corner point with average z value of 10 nearest
-                near_corner_points.append([corner_point[0], corner_point[1], sum(queried_z_vals) / len(queried_z_vals)])
+                return "".join(stdout_lines)
 
-            triangulation.insert(near_corner_points)
+            # Only the cell being refined is expanded into Vertex objects, inside the worker
+            vertices = {vertex_id: Vertex(x, y, z) for vertex_id, (x, y, z) in enumerate(points.tolist(), 1)}
 
             heap = []
 
@@ -161,34 +281,39 @@ class Triangulation:
 
                     heapify(heap)
 
-            if triangulation.number_of_vertices() > 4:
-                # Remove initial corners
-                for i in [1, 2, 3, 4]:
-                    triangulation.remove(i)
+            # Leave out the initial corners (unless nothing else was inserted) and the infinite vertex
+            corner_ids = range(1, len(near_corner_points) + 1) if triangulation.number_of_vertices() > len(near_corner_points) else []
 
-            # Output all remaining vertices
-            for vertex in triangulation.all_vertices():
-                if vertex[0] > 0:  # Exclude infinite vertex
-                    stdout_lines.append("v " + str(vertex[0]) + " " + str(vertex[1]) + " " + str(vertex[2]) + "\n")
+            stdout_lines.append(format_vertices(triangulation.all_vertices(), corner_ids, OUTPUT_PRECISION))
 
-        with lock:
-            stdout_lines.append(input_line)
-            sys.stdout.write("".join(stdout_lines))
-            sys.stdout.flush()
+        stdout_lines.append(input_line)
 
         sys.stderr.write(current_process().name + " - FINISHED.\n")
 
+        return "".join(stdout_lines)
+
 
 class Processor:
     def __init__(self, dt):
         self.triangulation = dt
 
+        self.points = SharedPointArena() if USE_SHARED_MEMORY else PointBuffer()
+
+        self.writer = StreamWriter(sys.stdout.buffer)
+
+        # Cell output is written in finalizer order rather than in the order workers finish
+        self.output = ReorderBuffer(self.writer, REORDER_BUFFER_SIZE)
+
         self.sprinkling = True
-        self.processes = []
+
+        # Candidates for the corner points of the cell being read, set up once the bbox and cell size are known
+        self.corner_seeds = None
+
+        # Splits dense cells before they are queued, set up together with the corner seeds
+        self.subdivider = None
 
         self.last_log_time = round(time.time())
 
-        self.stdout_lock = Lock()
         self.memory_usage_queue = Queue()
 
         self.memory_usage_queue.put(MemoryUsage("Main", self.last_log_time, psutil.Process(os.getpid()).memory_info().rss))
@@ -196,6 +321,11 @@ class Processor:
         self.memory_usage_writer = Process(target=self.write_memory_usage, args=(self.memory_usage_queue,), daemon=True)
         self.memory_usage_writer.start()
 
+        self.pool = CellPool(self.triangulation.finalize, PROCESS_COUNT, shared_args=(self.memory_usage_queue,))
+
+        # Cells waiting for a free worker are queued, and spilled to disk past the memory budget, instead of blocking the input
+        self.pending = PendingCells(self.pool, PENDING_MEMORY_BUDGET, SPILL_BUDGET)
+
     def write_memory_usage(self, memory_usage_queue):
         with open(os.path.join(os.getcwd(), "memlog_refinement.csv"), "a") as memory_log_file:
             while True:
@@ -207,11 +337,14 @@ class Processor:
                 else:
                     time.sleep(0.5)
 
-    def process_line(self, input_line):
-        split_line = input_line.rstrip("\n").split(" ")
+    def finish_cell(self, ticket, points, output):
+        self.points.release(points)
+
+        # A failed cell produces no output, as before
+        self.output.complete(ticket, output)
 
-        identifier = split_line[0]
-        data = split_line[1:]
+    def process_event(self, event):
+        identifier = event.identifier
 
         current_time = round(time.time())
 
@@ -219,82 +352,75 @@ class Processor:
             self.memory_usage_queue.put(MemoryUsage("Main", current_time, psutil.Process(os.getpid()).memory_info().rss))
             self.last_log_time = current_time
 
-        if identifier == "#" or identifier == "":
-            if data[0] == "endsprinkle":
-                self.sprinkling = False
-                sys.stderr.write("Sprinkling done!\n")
+        if identifier == "#":
+            # endsprinkle
+            self.sprinkling = False
+            sys.stderr.write("Sprinkling done!\n")
 
         elif identifier == "n":
             # Total number of points
-            self.triangulation.total_points = int(data[0])
-            sys.stdout.write(input_line)
+            self.triangulation.total_points = int(event.values[0])
+            self.output.write(event.text)
 
         elif identifier == "c":
             # Grid dimensions (cXc)
-            sys.stdout.write(input_line)
+            self.output.write(event.text)
 
         elif identifier == "s":
             # Cell size
-            self.triangulation.cell_size = int(data[0])
-            sys.stdout.write(input_line)
+            self.triangulation.cell_size = int(event.values[0])
+            self.output.write(event.text)
 
         elif identifier == "b":
             # bbox
-            self.triangulation.set_bbox(float(data[0]), float(data[1]), float(data[2]), float(data[3]))
-            sys.stdout.write(input_line)
+            self.triangulation.set_bbox(float(event.values[0]), float(event.values[1]), float(event.values[2]), float(event.values[3]))
+            self.corner_seeds = CornerSeeds(self.triangulation.min_x, self.triangulation.min_y, self.triangulation.cell_size)
+            self.subdivider = CellSubdivider(self.triangulation.min_x, self.triangulation.min_y, self.triangulation.cell_size, SUBDIVISION_THRESHOLD, self.points)
+            self.output.write(event.text)
 
         elif identifier == "v":
             # vertex
             # All sprinkle points get passed to output directly
             if not self.sprinkling:
-                self.triangulation.insert_vertex(float(data[0]), float(data[1]), float(data[2]))
+                self.points.extend(event.points)
+                self.corner_seeds.add(event.points)
 
             else:
-                sys.stdout.write(input_line)
+                self.output.write(event.text)
 
         elif identifier == "x":
             # cell finalizer
             # While sprinkling, don't bother processing since all finalized cells now are still empty anyways
             if self.sprinkling:
-                sys.stdout.write(input_line)
+                self.output.write(event.text)
                 return
 
-            sys.stderr.write("Starting new process to finalize cell: {}, {}. Processing currently running: {}\n".format(data[0], data[1], len(self.processes)))
+            sys.stderr.write("Submitting cell to worker pool: {}, {}. Cells currently running: {}, queued: {}\n".format(event.grid_x, event.grid_y, self.pool.running, len(self.pending)))
             sys.stderr.flush()
 
-            sleep_time = 1
+            points = self.points.take()
+            corner_seeds = self.corner_seeds.take(event.grid_x, event.grid_y)
+            ticket = self.output.reserve()
 
-            # Ensure total number of processes never exceeds capacity
-            while len(self.processes) >= cpu_count() - 4:
-                for i in reversed(range(len(self.processes))):
-                    if not self.processes[i].is_alive():
-                        del self.processes[i]
-
-                time.sleep(sleep_time)
-
-            process = Process(target=self.triangulation.finalize, args=(input_line, int(data[0]), int(data[1]), self.triangulation.vertices, self.stdout_lock, self.memory_usage_queue,), daemon=True)
-            self.triangulation.vertices = {}
-            self.triangulation.vertex_id = 1
-            self.processes.append(process)
-            process.start()
+            self.subdivider.submit(self.pending, event.text, event.grid_x, event.grid_y, corner_seeds, points, callback=partial(self.finish_cell, ticket))
 
         else:
             # Unknown identifier in stream
             pass
 
-        sys.stdout.flush()
-
 
 if __name__ == "__main__":
     triangulation = Triangulation()
     processor = Processor(triangulation)
     start_time = time.time()
 
-    for stdin_line in sys.stdin:
-        processor.process_line(stdin_line)
+    for event in read_events(sys.stdin.buffer):
+        processor.process_event(event)
+
+    processor.pending.join()
+    processor.writer.close()
 
-    for process in processor.processes:
-        process.join()
+    processor.points.close()
 
     processor.memory_usage_writer.terminate()
 
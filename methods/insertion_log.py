@@ -0,0 +1,155 @@
+import struct
+
+import numpy as np
+
+from binary_stream import RECORD
+from reorder_buffer import ReorderBuffer
+from stream_writer import StreamWriter
+from vertex_format import format_vertices
+
+# Written once at the start of an insertion log so it can't be mistaken for a stream
+MAGIC = b"SSTI\x01\n"
+
+THRESHOLD = b"R"
+TEXT = b"T"
+INSERTIONS = b"I"
+
+# Threshold the log was recorded at, and whether points with an error of exactly the threshold were inserted
+THRESHOLD_PAYLOAD = struct.Struct("<d?")
+
+# Little-endian float64 x, y, z and the error of the vertex when it was inserted, per vertex in insertion order; the
+# vertices every run starts with (the corners, points outside their hull) have an infinite error
+INSERTION_DTYPE = np.dtype("<f8")
+
+
+def encode_threshold(threshold, inclusive):
+    return RECORD.pack(THRESHOLD, THRESHOLD_PAYLOAD.size) + THRESHOLD_PAYLOAD.pack(threshold, inclusive)
+
+
+def encode_text(text):
+    # Sub-cells have no finalizer line of their own; nothing to write for them
+    if not text:
+        return b""
+
+    payload = text.encode()
+
+    return RECORD.pack(TEXT, len(payload)) + payload
+
+
+def insertion_rows(vertices, errors):
+    # vertices: all_vertices() of a triangulation nothing was removed from, errors: the error of every vertex inserted
+    # after the initial ones, in order
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)[1:]
+
+    rows = np.empty((len(vertices), 4), dtype=INSERTION_DTYPE)
+    rows[:, :3] = vertices
+    rows[:, 3] = np.inf
+    rows[len(vertices) - len(errors):, 3] = errors
+
+    return rows
+
+
+def encode_insertions(rows):
+    payload = rows.tobytes()
+
+    return RECORD.pack(INSERTIONS, len(payload)) + payload
+
+
+def read_insertion_log(stream):
+    # Yields (threshold, inclusive) first, then the text of TEXT records and the (N, 4) arrays of INSERTIONS records
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not an insertion log")
+
+    while True:
+        record = stream.read(RECORD.size)
+
+        if len(record) < RECORD.size:
+            break
+
+        record_type, length = RECORD.unpack(record)
+        payload = stream.read(length)
+
+        if record_type == THRESHOLD:
+            yield THRESHOLD_PAYLOAD.unpack(payload)
+
+        elif record_type == TEXT:
+            yield payload.decode()
+
+        elif record_type == INSERTIONS:
+            yield np.frombuffer(payload, dtype=INSERTION_DTYPE).reshape(-1, 4)
+
+        # Unknown record types are skipped
+
+
+def cut_insertions(rows, threshold, inclusive, precision=None):
+    # A run at a higher threshold inserts the very same points, up to the first one that is no longer above it
+    below = rows[:, 3] < threshold if inclusive else rows[:, 3] <= threshold
+    cut = np.argmax(below) if below.any() else len(rows)
+
+    return format_vertices(rows[:cut, :3], precision=precision)
+
+
+def extract_insertions(stream, threshold, precision=None):
+    # Yields the output of a run at threshold from an insertion log, in the order it was recorded
+    records = read_insertion_log(stream)
+
+    recorded_threshold, inclusive = next(records)
+
+    if threshold < recorded_threshold:
+        raise ValueError("Log was recorded at threshold {}, it can't be cut at {}".format(recorded_threshold, threshold))
+
+    cell = []
+
+    for record in records:
+        if not isinstance(record, str):
+            cell.append(cut_insertions(record, threshold, inclusive, precision))
+            continue
+
+        if cell:
+            # The sub-cells of a split cell share the seeds on their common boundaries; write those only once
+            yield "".join(dict.fromkeys("".join(cell).splitlines(keepends=True)))
+            cell = []
+
+        yield record
+
+    if cell:
+        yield "".join(dict.fromkeys("".join(cell).splitlines(keepends=True)))
+
+
+class InsertionLog:
+    def __init__(self, output, path, threshold, inclusive, max_held_size):
+        # Stands in for the method's ReorderBuffer: everything still goes to output, and to the log in the same order
+        self.output = output
+
+        self.file = open(path, "wb")
+        self.writer = StreamWriter(self.file)
+
+        self.writer.write(MAGIC + encode_threshold(threshold, inclusive))
+
+        self.log = ReorderBuffer(self.writer, max_held_size)
+
+    def reserve(self):
+        # Both buffers hand out tickets in lockstep
+        self.log.reserve()
+
+        return self.output.reserve()
+
+    def write(self, output):
+        self.output.write(output)
+        self.log.write(encode_text(output))
+
+    def complete(self, ticket, output):
+        # Cells come back as their output together with their log records; a failed cell has neither, and text
+        # without any insertions (an empty cell's finalizer) goes to both as it is. The output may itself be a tuple for
+        # the levels of detail below
+        if output is None or isinstance(output, str):
+            text, log = output, encode_text(output)
+        else:
+            text, log = output
+
+        self.output.complete(ticket, text)
+        self.log.complete(ticket, log)
+
+    def close(self):
+        self.writer.close()
+        self.file.close()
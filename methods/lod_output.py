@@ -0,0 +1,58 @@
+from insertion_log import cut_insertions
+from reorder_buffer import ReorderBuffer
+from stream_writer import StreamWriter
+
+
+def cut_levels(rows, thresholds, inclusive, input_line, precision=None):
+    # The block of every level of detail for a cell, from its insertions; rows is None for a cell without points
+    if rows is None:
+        return (input_line,) * len(thresholds)
+
+    return tuple(cut_insertions(rows, threshold, inclusive, precision) + input_line for threshold in thresholds)
+
+
+class LevelsOfDetail:
+    def __init__(self, output, levels, min_threshold, max_held_size):
+        # Stands in for the method's ReorderBuffer: everything still goes to output, and to every level's file in the
+        # same order; levels is a list of (threshold, path)
+        if any(threshold < min_threshold for threshold, _ in levels):
+            raise ValueError("Levels of detail can't be finer than the threshold cells are refined to ({})".format(min_threshold))
+
+        self.output = output
+
+        # A FIFO only opens once its reader is there, so start one for every level before the method
+        self.files = [open(path, "wb") for _, path in levels]
+        self.writers = [StreamWriter(level_file) for level_file in self.files]
+
+        self.levels = [ReorderBuffer(writer, max_held_size) for writer in self.writers]
+
+    def reserve(self):
+        # All buffers hand out tickets in lockstep
+        for level in self.levels:
+            level.reserve()
+
+        return self.output.reserve()
+
+    def write(self, output):
+        # Headers, sprinkle points and finalizers of empty cells are the same at every level
+        self.output.write(output)
+
+        for level in self.levels:
+            level.write(output)
+
+    def complete(self, ticket, output):
+        # Cells come back as their output together with the block of every level; a failed cell has none of them
+        if output is None or isinstance(output, str):
+            text, level_outputs = output, (output,) * len(self.levels)
+        else:
+            text, level_outputs = output
+
+        self.output.complete(ticket, text)
+
+        for level, level_output in zip(self.levels, level_outputs):
+            level.complete(ticket, level_output)
+
+    def close(self):
+        for writer, level_file in zip(self.writers, self.files):
+            writer.close()
+            level_file.close()
@@ -4,7 +4,29 @@ import os
 import time
 import psutil
 
-from multiprocessing import Process, Queue, current_process, Lock
+from functools import partial
+from multiprocessing import Process, Queue, current_process
+
+from cell_pool import CellPool
+from pending_cells import PendingCells
+from point_buffer import PointBuffer, as_array
+from reorder_buffer import ReorderBuffer
+from shared_points import SharedPointArena
+from stream_parser import read_events
+from stream_writer import StreamWriter
+
+# Hand cells to workers through shared memory instead of pickling their points
+USE_SHARED_MEMORY = False
+
+# Bytes of finished cells held back to keep the output in stream order; 0 writes cells as soon as they finish
+REORDER_BUFFER_SIZE = 1 << 28
+
+# Bytes of points of cells waiting for a worker kept in memory, and spilled to disk after that, before input is paused
+PENDING_MEMORY_BUDGET = 1 << 30
+SPILL_BUDGET = 1 << 36
+
+# Number of long-lived worker processes finalizing cells; None uses all cores not taken by sstfin and sstdt
+PROCESS_COUNT = None
 
 
 class MemoryUsage:
@@ -33,9 +55,11 @@ class Triangulation:
         self.min_z = min_z
         self.max_z = max_z
 
-    def finalize(self, input_line, vertices, lock, memory_usage_queue):
+    def finalize(self, input_line, vertices, memory_usage_queue):
         stdout_lines = []
 
+        vertices = as_array(vertices).tolist()
+
         if len(vertices) > 0:
 
             for i in reversed(range(len(vertices))):
@@ -64,26 +88,28 @@ class Triangulation:
 
             stdout_lines.append(masb.communicate(input_data)[0])
 
-        with lock:
-            stdout_lines.append(input_line)
-            sys.stdout.write("".join(stdout_lines))
-            sys.stdout.flush()
+        stdout_lines.append(input_line)
 
         sys.stderr.write(current_process().name + " - FINISHED.\n")
 
+        return "".join(stdout_lines)
+
 
 class Processor:
     def __init__(self, dt):
         self.triangulation = dt
 
         self.sprinkling = True
-        self.processes = []
 
-        self.vertices = []
+        self.points = SharedPointArena() if USE_SHARED_MEMORY else PointBuffer()
+
+        self.writer = StreamWriter(sys.stdout.buffer)
+
+        # Cell output is written in finalizer order rather than in the order workers finish
+        self.output = ReorderBuffer(self.writer, REORDER_BUFFER_SIZE)
 
         self.last_log_time = round(time.time())
 
-        self.stdout_lock = Lock()
         self.memory_usage_queue = Queue()
 
         self.memory_usage_queue.put(MemoryUsage("Main", self.last_log_time, psutil.Process(os.getpid()).memory_info().rss))
@@ -91,6 +117,11 @@ class Processor:
         self.memory_usage_writer = Process(target=self.write_memory_usage, args=(self.memory_usage_queue,), daemon=True)
         self.memory_usage_writer.start()
 
+        self.pool = CellPool(self.triangulation.finalize, PROCESS_COUNT, shared_args=(self.memory_usage_queue,))
+
+        # Cells waiting for a free worker are queued, and spilled to disk past the memory budget, instead of blocking the input
+        self.pending = PendingCells(self.pool, PENDING_MEMORY_BUDGET, SPILL_BUDGET)
+
     def write_memory_usage(self, memory_usage_queue):
         with open(os.path.join(os.getcwd(), "memlog_mat.csv"), "a") as memory_log_file:
             while True:
@@ -102,11 +133,14 @@ class Processor:
                 else:
                     time.sleep(0.5)
 
-    def process_line(self, input_line):
-        split_line = input_line.rstrip("\n").split(" ")
+    def finish_cell(self, ticket, points, output):
+        self.points.release(points)
+
+        # A failed cell produces no output, as before
+        self.output.complete(ticket, output)
 
-        identifier = split_line[0]
-        data = split_line[1:]
+    def process_event(self, event):
+        identifier = event.identifier
 
         current_time = round(time.time())
 
@@ -114,81 +148,71 @@ class Processor:
             self.memory_usage_queue.put(MemoryUsage("Main", current_time, psutil.Process(os.getpid()).memory_info().rss))
             self.last_log_time = current_time
 
-        if identifier == "#" or identifier == "":
-            if data[0] == "endsprinkle":
-                self.sprinkling = False
-                sys.stderr.write("Sprinkling done!\n")
+        if identifier == "#":
+            # endsprinkle
+            self.sprinkling = False
+            sys.stderr.write("Sprinkling done!\n")
 
         elif identifier == "n":
             # Total number of points
-            self.triangulation.total_points = int(data[0])
-            sys.stdout.write(input_line)
+            self.triangulation.total_points = int(event.values[0])
+            self.output.write(event.text)
 
         elif identifier == "c":
             # Grid dimensions (cXc)
-            sys.stdout.write(input_line)
+            self.output.write(event.text)
 
         elif identifier == "s":
             # Cell size
-            self.triangulation.cell_size = int(data[0])
-            sys.stdout.write(input_line)
+            self.triangulation.cell_size = int(event.values[0])
+            self.output.write(event.text)
 
         elif identifier == "b":
             # bbox
-            self.triangulation.set_bbox(float(data[0]), float(data[1]), float(data[2]), float(data[3]), float(data[4]), float(data[5]))
-            sys.stdout.write(input_line)
+            self.triangulation.set_bbox(float(event.values[0]), float(event.values[1]), float(event.values[2]), float(event.values[3]), float(event.values[4]), float(event.values[5]))
+            self.output.write(event.text)
 
         elif identifier == "v":
             # vertex
             # All sprinkle points get passed to output directly
             if not self.sprinkling:
-                self.vertices.append([float(data[0]), float(data[1]), float(data[2])])
+                self.points.extend(event.points)
 
             else:
-                sys.stdout.write(input_line)
+                self.output.write(event.text)
 
         elif identifier == "x":
             # cell finalizer
             # While sprinkling, don't bother processing since all finalized cells now are still empty anyways
             if self.sprinkling:
-                sys.stdout.write(input_line)
+                self.output.write(event.text)
                 return
 
-            sys.stderr.write("Starting new process to finalize cell: {}, {}. Processing currently running: {}\n".format(data[0], data[1], len(self.processes)))
+            sys.stderr.write("Submitting cell to worker pool: {}, {}. Cells currently running: {}, queued: {}\n".format(event.grid_x, event.grid_y, self.pool.running, len(self.pending)))
             sys.stderr.flush()
 
-            sleep_time = 1
+            points = self.points.take()
+            ticket = self.output.reserve()
 
-            # Ensure total number of processes never exceeds capacity
-            while len(self.processes) >= 4:
-                for i in reversed(range(len(self.processes))):
-                    if not self.processes[i].is_alive():
-                        del self.processes[i]
-
-                time.sleep(sleep_time)
-
-            process = Process(target=self.triangulation.finalize, args=(input_line, self.vertices, self.stdout_lock, self.memory_usage_queue,), daemon=True)
-            self.vertices = []
-            self.processes.append(process)
-            process.start()
+            self.pending.submit(event.text, points, callback=partial(self.finish_cell, ticket))
 
         else:
             # Unknown identifier in stream
             pass
 
-        sys.stdout.flush()
-
 
 if __name__ == "__main__":
     triangulation = Triangulation()
     processor = Processor(triangulation)
     start_time = time.time()
 
-    for stdin_line in sys.stdin:
-        processor.process_line(stdin_line)
+    for event in read_events(sys.stdin.buffer):
+        processor.process_event(event)
+
+    processor.pending.join()
+    processor.writer.close()
 
-    for process in processor.processes:
-        process.join()
+    processor.points.close()
 
     processor.memory_usage_writer.terminate()
 
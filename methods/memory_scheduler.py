@@ -0,0 +1,82 @@
+import os
+import psutil
+import resource
+import sys
+
+from multiprocessing import cpu_count
+
+# Cores left to the other programs in the pipeline (sstfin and sstdt)
+RESERVED_CORES = 2
+
+# Share of the available memory that admitted cells are allowed to take up
+MEMORY_FRACTION = 0.8
+
+# Bytes per point assumed for a cell before any cell has been measured
+INITIAL_BYTES_PER_POINT = 2048
+
+# Weight of the newest measurement in the running bytes per point estimate
+SMOOTHING = 0.25
+
+# Seconds between checks of the available memory while a cell waits to be admitted
+ADMISSION_INTERVAL = 1.0
+
+
+def available_cores(reserved_cores=RESERVED_CORES):
+    # Respect taskset / container CPU limits where the platform exposes them
+    try:
+        cores = len(os.sched_getaffinity(0))
+
+    except AttributeError:
+        cores = cpu_count()
+
+    return max(1, cores - reserved_cores)
+
+
+def peak_rss():
+    # Highest resident set size of this process so far; reported in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemoryScheduler:
+    def __init__(self, memory_fraction=MEMORY_FRACTION, initial_bytes_per_point=INITIAL_BYTES_PER_POINT, smoothing=SMOOTHING):
+        self.memory_fraction = memory_fraction
+        self.bytes_per_point = initial_bytes_per_point
+        self.smoothing = smoothing
+
+        self.measured = False
+
+        # job_id -> estimated bytes of the cells currently on a worker
+        self.admitted = {}
+
+    def estimate(self, point_count):
+        return self.bytes_per_point * point_count
+
+    def can_admit(self, point_count):
+        # Always let one cell through, however large, so a huge cell can't stall the stream forever
+        if not self.admitted:
+            return True
+
+        available = psutil.virtual_memory().available * self.memory_fraction
+
+        return sum(self.admitted.values()) + self.estimate(point_count) <= available
+
+    def admit(self, job_id, point_count):
+        self.admitted[job_id] = self.estimate(point_count)
+
+    def finish(self, job_id, point_count, memory_used):
+        self.admitted.pop(job_id, None)
+
+        # Cells that didn't grow the worker past its earlier peak tell nothing about their size
+        if not point_count or not memory_used:
+            return
+
+        bytes_per_point = memory_used / point_count
+
+        if not self.measured:
+            self.bytes_per_point = bytes_per_point
+            self.measured = True
+
+        else:
+            self.bytes_per_point += self.smoothing * (bytes_per_point - self.bytes_per_point)
@@ -0,0 +1,144 @@
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from collections import deque
+from functools import partial
+
+from shared_points import POINT_SIZE
+
+# Bytes of points of queued cells kept in memory while all workers are busy
+MEMORY_BUDGET = 1 << 30
+
+# Bytes of points of queued cells written to disk before reading the input is paused
+SPILL_BUDGET = 1 << 36
+
+# Directory in which each run creates its own directory for spilled cells; None uses the system temporary directory
+SPILL_DIRECTORY = None
+
+
+class SpilledPoints:
+    def __init__(self, path, count):
+        self.path = path
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def attach(self):
+        # Read straight from the page cache instead of loading the file
+        return np.memmap(self.path, dtype=np.float64, mode="r", shape=(self.count, 3))
+
+
+class PendingCells:
+    def __init__(self, pool, memory_budget=MEMORY_BUDGET, spill_budget=SPILL_BUDGET, spill_directory=SPILL_DIRECTORY):
+        self.pool = pool
+
+        self.memory_budget = memory_budget
+        self.spill_budget = spill_budget
+        self.spill_directory = spill_directory
+
+        # Directory of this run's spilled cells, created at the first spill; removed at exit, also when the run is
+        # aborted, so no point files are left behind
+        self.spill_files = None
+
+        # (args, callback) of cells waiting for a worker, in stream order
+        self.queue = deque()
+
+        self.memory_size = 0
+        self.spill_size = 0
+
+        self.condition = threading.Condition()
+
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def submit(self, *args, callback=None):
+        # Fork the workers from the main thread rather than from the dispatcher thread
+        self.pool.start()
+
+        # The points of the cell are always the last argument of a job
+        points = args[-1]
+        size = len(points) * POINT_SIZE
+
+        with self.condition:
+            # Spilling only helps for points held in this process' memory
+            spillable = isinstance(points, np.ndarray) and len(points) > 0
+
+            while self.queue and self.memory_size + size > self.memory_budget and (not spillable or self.spill_size + size > self.spill_budget):
+                # Out of memory and disk budget: stop reading the input until a cell is handed to a worker or done
+                self.condition.wait()
+
+            spill = self.memory_size + size > self.memory_budget and spillable and self.spill_size + size <= self.spill_budget
+
+            if spill:
+                self.spill_size += size
+            else:
+                self.memory_size += size
+
+        if spill:
+            points = self.spill(points)
+            args = args[:-1] + (points,)
+
+        with self.condition:
+            self.queue.append((args, partial(self.finish, points, size, spill, callback)))
+            self.condition.notify_all()
+
+    def spill(self, points):
+        if self.spill_files is None:
+            self.spill_files = tempfile.TemporaryDirectory(prefix="spill-", dir=self.spill_directory)
+
+        descriptor, path = tempfile.mkstemp(suffix=".cell", dir=self.spill_files.name)
+
+        with os.fdopen(descriptor, "wb") as spill_file:
+            points.tofile(spill_file)
+
+        return SpilledPoints(path, len(points))
+
+    def dispatch(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+
+                job = self.queue.popleft()
+
+            if job is None:
+                break
+
+            args, callback = job
+
+            # Blocks until a worker is free and the cell fits in memory; the next cells keep queueing up in the meantime
+            self.pool.submit(*args, callback=callback, point_count=len(args[-1]))
+
+            if not isinstance(args[-1], SpilledPoints):
+                with self.condition:
+                    self.memory_size -= len(args[-1]) * POINT_SIZE
+                    self.condition.notify_all()
+
+    def finish(self, points, size, spilled, callback, result):
+        if spilled:
+            os.remove(points.path)
+
+            with self.condition:
+                self.spill_size -= size
+                self.condition.notify_all()
+
+        if callback is not None:
+            callback(points, result)
+
+    def join(self):
+        with self.condition:
+            self.queue.append(None)
+            self.condition.notify_all()
+
+        self.dispatcher.join()
+        self.pool.join()
+
+        if self.spill_files is not None:
+            self.spill_files.cleanup()
@@ -0,0 +1,61 @@
+import numpy as np
+
+# Number of points the buffer starts out with, doubled every time it runs full
+INITIAL_CAPACITY = 4096
+
+
+def as_array(points):
+    # Workers receive either a plain (N, 3) array or a descriptor of a block in shared memory
+    if hasattr(points, "attach"):
+        return points.attach()
+
+    return points
+
+
+class PointBuffer:
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.points = np.empty((capacity, 3), dtype=np.float64)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, count):
+        if count <= len(self.points):
+            return
+
+        points = np.empty((max(count, 2 * len(self.points)), 3), dtype=np.float64)
+        points[:self.count] = self.points[:self.count]
+
+        self.points = points
+
+    def append(self, x, y, z):
+        if self.count == len(self.points):
+            self.reserve(self.count + 1)
+
+        self.points[self.count] = (x, y, z)
+        self.count += 1
+
+    def extend(self, points):
+        self.reserve(self.count + len(points))
+
+        self.points[self.count:self.count + len(points)] = points
+        self.count += len(points)
+
+    def take(self):
+        # Hand off the accumulated cell as a compact array and start over, keeping the allocation for the next cell
+        points = self.points[:self.count].copy()
+        self.count = 0
+
+        return points
+
+    def view(self, points):
+        return points
+
+    def release(self, points):
+        # Plain arrays are owned by the worker once sent, nothing to free here
+        pass
+
+    def close(self):
+        self.points = np.empty((0, 3), dtype=np.float64)
+        self.count = 0
@@ -0,0 +1,70 @@
+import numpy as np
+
+HILBERT = "hilbert"
+BRIO = "brio"
+
+# Bits per axis of the Hilbert curve; 16 gives a 65536 x 65536 grid over the cell, far finer than the point spacing
+HILBERT_BITS = 16
+
+# Seed of the BRIO rounds, fixed so runs stay reproducible
+BRIO_SEED = 0
+
+
+def hilbert_indexes(points, bits=HILBERT_BITS):
+    # Distance of every point along a Hilbert curve over the bounding square of the points, for all points at once
+    low = points[:, :2].min(axis=0)
+    extent = max((points[:, :2].max(axis=0) - low).max(), 1E-9)
+
+    side = 1 << bits
+
+    grid = np.minimum(((points[:, :2] - low) / extent * side).astype(np.int64), side - 1)
+
+    x = grid[:, 0]
+    y = grid[:, 1]
+
+    indexes = np.zeros(len(points), dtype=np.int64)
+
+    step = side >> 1
+
+    while step > 0:
+        rx = (x & step) > 0
+        ry = (y & step) > 0
+
+        indexes += step * step * ((3 * rx) ^ ry)
+
+        # Rotate the quadrant so the curve inside it has the orientation of the full curve
+        flip = rx & ~ry
+
+        x = np.where(flip, side - 1 - x, x)
+        y = np.where(flip, side - 1 - y, y)
+
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+
+        step >>= 1
+
+    return indexes
+
+
+def brio_rounds(count, rng):
+    # Biased randomized insertion order: every point ends up in the last round with probability 1/2, in the one before
+    # with 1/4 and so on; returns the round of every point, 0 being the first
+    round_count = max(1, int(np.log2(max(count, 1))))
+
+    rounds_from_last = np.minimum(rng.geometric(0.5, count) - 1, round_count - 1)
+
+    return round_count - 1 - rounds_from_last
+
+
+def point_order(points, order):
+    # Indexes that put the points of a cell in the given order; consecutive points are close together, so the point
+    # location in the triangulation starts near the triangle of the previous point
+    hilbert = hilbert_indexes(points)
+
+    if order == HILBERT:
+        return np.argsort(hilbert, kind="stable")
+
+    if order == BRIO:
+        # Rounds from small to large, each along the Hilbert curve
+        return np.lexsort((hilbert, brio_rounds(len(points), np.random.default_rng(BRIO_SEED))))
+
+    raise ValueError("Unknown point order: {}".format(order))
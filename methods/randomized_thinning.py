@@ -1,56 +1,83 @@
-import random
 import sys
 
+import numpy as np
+
+from itertools import compress
 from math import floor
 
+from binary_stream import MAGIC, encode_event, encode_vertices
+from stream_parser import read_events
+from stream_writer import StreamWriter
+
 # 1 / THINNING_FACTOR points kept (on average)
 THINNING_FACTOR = 8
 
+# Write the binary stream format (binary_stream.py) instead of sst text, for chaining into another method
+BINARY_OUTPUT = False
+
 
 class Processor:
-    def process_line(self, input_line):
-        split_line = input_line.rstrip("\n").split(" ")
+    def __init__(self):
+        self.writer = StreamWriter(sys.stdout.buffer)
 
-        identifier = split_line[0]
+        if BINARY_OUTPUT:
+            self.writer.write(MAGIC)
 
-        if identifier == "#" or identifier == "":
-            pass
+    def write(self, event):
+        if BINARY_OUTPUT:
+            self.writer.write(encode_event(event))
+        else:
+            self.writer.write(event.text)
+
+    def process_event(self, event):
+        identifier = event.identifier
+
+        if identifier == "#":
+            # endsprinkle
+            # Passed on so a method further down the chain knows when its cells start
+            self.write(event)
 
         elif identifier == "n":
             # Total number of points
-            sys.stdout.write(input_line)
+            self.write(event)
 
         elif identifier == "c":
             # Grid dimensions (cXc)
-            sys.stdout.write(input_line)
+            self.write(event)
 
         elif identifier == "s":
             # Cell size
-            sys.stdout.write(input_line)
+            self.write(event)
 
         elif identifier == "b":
             # bbox
-            sys.stdout.write(input_line)
+            self.write(event)
 
         elif identifier == "v":
             # vertex
-            if random.randint(0, THINNING_FACTOR) == floor(THINNING_FACTOR / 2):
-                sys.stdout.write(input_line)
+            # Draw for the whole batch at once, keeping each line with the same odds as before
+            kept = np.random.randint(0, THINNING_FACTOR + 1, size=len(event.points)) == floor(THINNING_FACTOR / 2)
+
+            if BINARY_OUTPUT:
+                self.writer.write(encode_vertices(event.points[kept]))
+            else:
+                self.writer.write("".join(compress(event.text.splitlines(True), kept)))
 
         elif identifier == "x":
             # cell finalizer
-            sys.stdout.write(input_line)
+            self.write(event)
+            self.writer.flush()
 
         else:
             # Unknown identifier in stream
             pass
 
-        sys.stdout.flush()
-
 
 if __name__ == "__main__":
     processor = Processor()
 
-    for stdin_line in sys.stdin:
-        processor.process_line(stdin_line)
+    for event in read_events(sys.stdin.buffer):
+        processor.process_event(event)
+
+    processor.writer.close()
 
@@ -6,14 +6,64 @@ import startin
 
 import numpy as np
 
-from multiprocessing import cpu_count, Process
-from scipy.spatial import KDTree
+from functools import partial
+
+from cell_pool import CellPool
+from cell_subdivision import CellSubdivider
+from corner_seeds import CornerSeeds, nearest_z_values
+from insertion_log import InsertionLog, encode_insertions, encode_text, insertion_rows
+from lod_output import LevelsOfDetail, cut_levels
+from pending_cells import PendingCells
+from point_buffer import PointBuffer, as_array
+from reorder_buffer import ReorderBuffer
+from shared_points import SharedPointArena
+from stream_parser import read_events
+from stream_writer import StreamWriter
+from tin_interpolation import interpolate_tin_linear
+from triangle_buckets import TriangleBuckets
+from vertex_format import format_vertices
+from versioned_heap import VersionedHeap
 
 TRIANGULATION_THRESHOLD = 0.2
 DELTA_PRECISION = 1E4
 
+# Recompute errors only for the points in the triangles an insertion changed, and pick the worst point from a heap,
+# instead of interpolating every remaining point after each insertion
+INCREMENTAL_UPDATES = True
+
+# Digits after the decimal point of output vertices; None writes them exactly like str(float)
+OUTPUT_PRECISION = None
+
+# Hand cells to workers through shared memory instead of pickling their points
+USE_SHARED_MEMORY = False
+
+# Bytes of finished cells held back to keep the output in stream order; 0 writes cells as soon as they finish
+REORDER_BUFFER_SIZE = 1 << 28
+
+# Bytes of points of cells waiting for a worker kept in memory, and spilled to disk after that, before input is paused
+PENDING_MEMORY_BUDGET = 1 << 30
+SPILL_BUDGET = 1 << 36
+
+# Number of long-lived worker processes finalizing cells; None uses all cores not taken by sstfin and sstdt
+PROCESS_COUNT = None
+
+# Path of a binary sidecar recording every cell's insertions with their deltas, or None; tools/extract_insertion_log.py
+# cuts it into the output for any threshold of at least TRIANGULATION_THRESHOLD without triangulating again
+INSERTION_LOG = None
+
+# List of (threshold, path) of coarser levels of detail written in the same pass, or None; every path (a file or a FIFO
+# read by another sstdt) gets the output of a run at its threshold, cut from the insertions of the cells refined down to
+# TRIANGULATION_THRESHOLD, so no threshold may be below that
+LEVELS_OF_DETAIL = None
+
+# Cells with more points than this are split into quadtree sub-cells that are refined in parallel, seeded with shared
+# points on their common boundaries and written back as one cell; None never splits a cell
+SUBDIVISION_THRESHOLD = None
+
 
 class Vertex:
+    __slots__ = ("x", "y", "z", "delta_z")
+
     def __init__(self, x, y, z):
         self.x = x
         self.y = y
@@ -32,79 +82,152 @@ class Triangulation:
         self.max_x = None
         self.max_y = None
 
-        self.vertices = {}
-        self.vertex_id = 1
-
     def set_bbox(self, min_x, min_y, max_x, max_y):
         self.min_x = min_x
         self.min_y = min_y
         self.max_x = max_x
         self.max_y = max_y
 
-    def insert_vertex(self, x, y, z):
-        self.vertices[self.vertex_id] = Vertex(x, y, z)
-        self.vertex_id += 1
+    def update_deltas(self, heap, assigned):
+        for _, _, point_indexes, errors in assigned:
+            deltas = np.round(errors * DELTA_PRECISION) / DELTA_PRECISION
 
-    def finalize(self, input_line, grid_x, grid_y, vertices):
-        if len(vertices) > 0:
-            triangulation = startin.DT()
+            for point_index, delta in zip(point_indexes.tolist(), deltas.tolist()):
+                # Points that are close enough now don't need to stay in the heap
+                if delta > TRIANGULATION_THRESHOLD:
+                    heap.push(point_index, -delta)
+                else:
+                    heap.discard(point_index)
 
-            x_vals = []
-            y_vals = []
-            z_vals = []
+    def refine_incrementally(self, triangulation, points, corner_points):
+        # The points of the cell bucketed by the triangle they are in; the corners get vertex ids 1 to 4
+        buckets = TriangleBuckets(points, enumerate(corner_points, start=1))
 
-            for vertex_id, vertex in vertices.items():
-                x_vals.append(vertex.x)
-                y_vals.append(vertex.y)
-                z_vals.append(vertex.z)
+        assigned, outside = buckets.assign(triangulation.all_triangles(), np.arange(len(points)))
 
-            tree = KDTree(np.c_[x_vals, y_vals])
+        if len(outside) > 0:
+            # If outside CH, always insert
+            for x, y, z in points[outside].tolist():
+                triangulation.insert_one_pt(x, y, z, 0)
 
-            corner_points = [
-                [self.min_x + (self.cell_size * grid_x), self.min_y + (self.cell_size * grid_y)],
-                [self.min_x + (self.cell_size * grid_x) + self.cell_size - 1E-5, self.min_y + (self.cell_size * grid_y)],
-                [self.min_x + (self.cell_size * grid_x), self.min_y + (self.cell_size * grid_y) + self.cell_size - 1E-5],
-                [self.min_x + (self.cell_size * grid_x) + self.cell_size - 1E-5, self.min_y + (self.cell_size * grid_y) + self.cell_size - 1E-5]
-            ]
+            vertices = {vertex_id: vertex for vertex_id, vertex in enumerate(triangulation.all_vertices()) if vertex_id > 0}
 
-            near_corner_points = []
+            buckets = TriangleBuckets(points, vertices)
+            assigned, _ = buckets.assign(triangulation.all_triangles(), np.setdiff1d(np.arange(len(points)), outside))
+
+        # Point indexes by rounded delta, largest first; only points above the threshold are kept
+        heap = VersionedHeap()
+
+        self.update_deltas(heap, assigned)
+
+        loop_time = time.time()
+        inserted_count = 0
+
+        # Delta of every vertex inserted from here on, in insertion order
+        errors = []
 
-            for corner_point in corner_points:
-                # Get nearest point to corner
-                distances, indexes = tree.query(corner_point, k=10)
+        while heap:
+            if inserted_count % 100 == 0:
+                sys.stderr.write("Points above threshold: {}, time since last 100: {}\n".format(len(heap), time.time() - loop_time))
+                sys.stderr.flush()
+                loop_time = time.time()
 
-                queried_z_vals = [z_vals[index] for index in indexes if index < len(z_vals)]
+            priority, point_index = heap.pop()
+
+            vertex_count = triangulation.number_of_vertices()
+
+            try:
+                _, assigned = buckets.insert(triangulation, point_index)
+                inserted_count += 1
+
+            # Somehow point is outside bbox, ignore
+            except OSError:
+                continue
+
+            # A duplicate of an existing vertex adds no vertex to log
+            if triangulation.number_of_vertices() > vertex_count:
+                errors.append(-priority)
+
+            # Only the points of the triangles around the new vertex got a different interpolation
+            self.update_deltas(heap, assigned)
+
+        return errors
+
+    def cell_output(self, stdout_lines, input_line, rows=None):
+        stdout_lines.append(input_line)
+
+        output = "".join(stdout_lines)
+
+        # Every level of detail holds the cell's insertions up to the first one that was no longer above its threshold
+        if LEVELS_OF_DETAIL is not None:
+            output = output, cut_levels(rows, [threshold for threshold, _ in LEVELS_OF_DETAIL], False, input_line, OUTPUT_PRECISION)
+
+        if INSERTION_LOG is None:
+            return output
+
+        # The cell's insertions travel with its output, so the main process writes them in the same order
+        return output, (encode_insertions(rows) if rows is not None else b"") + encode_text(input_line)
+
+    def finalize(self, input_line, grid_x, grid_y, corner_seeds, vertices):
+        stdout_lines = []
+        rows = None
+
+        points = as_array(vertices)
+
+        if len(points) > 0:
+            triangulation = startin.DT()
+
+            near_corner_points = []
 
+            # Points near the corners were picked out while the cell was read; only sparse corners need the whole cell
+            for x, y, queried_z_vals in nearest_z_values(corner_seeds, points):
                 # add a corner point with average z value of 10 nearest
-                near_corner_points.append([corner_point[0], corner_point[1], sum(queried_z_vals) / len(queried_z_vals)])
+                near_corner_points.append([x, y, queried_z_vals.mean()])
 
             triangulation.insert(near_corner_points)
 
-            worst_point_index = 1
+            if INCREMENTAL_UPDATES:
+                errors = self.refine_incrementally(triangulation, points, near_corner_points)
 
-            for vertex_id, vertex in vertices.items():
-                try:
-                    interpolated_value = triangulation.interpolate_tin_linear(vertex.x, vertex.y)
+                triangulation_vertices = triangulation.all_vertices()
 
-                    vertex.delta_z = round(abs(interpolated_value - vertex.z) * DELTA_PRECISION) / DELTA_PRECISION
+                stdout_lines.append(format_vertices(triangulation_vertices, precision=OUTPUT_PRECISION))
 
-                    if vertex.delta_z > vertices[worst_point_index].delta_z:
-                        worst_point_index = vertex_id
+                return self.cell_output(stdout_lines, input_line, insertion_rows(triangulation_vertices, errors))
+
+            # Only the cell being refined is expanded into Vertex objects, inside the worker
+            vertices = {vertex_id: Vertex(x, y, z) for vertex_id, (x, y, z) in enumerate(points.tolist(), 1)}
+
+            worst_point_index = 1
+
+            # The whole cell is interpolated against the corners at once
+            interpolated_values, outside = interpolate_tin_linear(triangulation, points)
 
+            for (vertex_id, vertex), interpolated_value, is_outside in zip(vertices.items(), interpolated_values.tolist(), outside.tolist()):
                 # If outside CH, always insert
-                except OSError:
-                    triangulation.insert_one_pt(vertex[0], vertex[1], vertex[2], 0)
+                if is_outside:
+                    triangulation.insert_one_pt(vertex.x, vertex.y, vertex.z, 0)
+                    continue
+
+                vertex.delta_z = round(abs(interpolated_value - vertex.z) * DELTA_PRECISION) / DELTA_PRECISION
+
+                if vertex.delta_z > vertices[worst_point_index].delta_z:
+                    worst_point_index = vertex_id
 
             loop_time = time.time()
 
             largest_delta = vertices[worst_point_index]
 
+            errors = []
+
             while True:
                 if len(vertices) % 100 == 0:
                     sys.stderr.write("Vertices left: {}, time since last 100: {}\n".format(len(vertices), time.time() - loop_time))
                     sys.stderr.flush()
                     loop_time = time.time()
 
+                vertex_count = triangulation.number_of_vertices()
+
                 try:
                     if largest_delta.delta_z > TRIANGULATION_THRESHOLD:
                         triangulation.insert_one_pt(largest_delta.x, largest_delta.y, largest_delta.z, 0)
@@ -115,9 +238,13 @@ class Triangulation:
                 except OSError:
                     pass
 
-                for vertex_id, vertex in vertices.items():
-                    interpolated_value = triangulation.interpolate_tin_linear(vertex.x, vertex.y)
+                if triangulation.number_of_vertices() > vertex_count:
+                    errors.append(largest_delta.delta_z)
+
+                # Vertex ids are the (1-based) indexes of the points of the cell
+                interpolated_values, _ = interpolate_tin_linear(triangulation, points[np.fromiter(vertices, dtype=np.int64) - 1])
 
+                for (vertex_id, vertex), interpolated_value in zip(vertices.items(), interpolated_values.tolist()):
                     vertex.delta_z = round(abs(interpolated_value - vertex.z) * DELTA_PRECISION) / DELTA_PRECISION
 
                     if vertex.delta_z > vertices[worst_point_index].delta_z:
@@ -128,99 +255,130 @@ class Triangulation:
                 del vertices[worst_point_index]
                 worst_point_index = random.choice(list(vertices.keys()))
 
-            for vertex in triangulation.all_vertices():
-                if vertex[0] > 0:  # Exclude infinite vertex
-                    sys.stdout.write("v " + str(vertex[0]) + " " + str(vertex[1]) + " " + str(vertex[2]) + "\n")
+            triangulation_vertices = triangulation.all_vertices()
+
+            stdout_lines.append(format_vertices(triangulation_vertices, precision=OUTPUT_PRECISION))
+
+            rows = insertion_rows(triangulation_vertices, errors)
 
-        sys.stdout.write(input_line)
-        sys.stdout.flush()
+        return self.cell_output(stdout_lines, input_line, rows)
 
 
 class Processor:
     def __init__(self, dt):
         self.triangulation = dt
 
+        self.points = SharedPointArena() if USE_SHARED_MEMORY else PointBuffer()
+
+        self.writer = StreamWriter(sys.stdout.buffer)
+
+        # Cell output is written in finalizer order rather than in the order workers finish
+        self.output = ReorderBuffer(self.writer, REORDER_BUFFER_SIZE)
+
+        # Every level of detail gets everything the output gets, with the cells cut at its threshold
+        self.levels_of_detail = None
+
+        if LEVELS_OF_DETAIL is not None:
+            self.levels_of_detail = LevelsOfDetail(self.output, LEVELS_OF_DETAIL, TRIANGULATION_THRESHOLD, REORDER_BUFFER_SIZE)
+            self.output = self.levels_of_detail
+
+        # The insertion log gets everything the output gets, with the cells' insertions instead of their vertices
+        if INSERTION_LOG is not None:
+            self.output = InsertionLog(self.output, INSERTION_LOG, TRIANGULATION_THRESHOLD, False, REORDER_BUFFER_SIZE)
+
         self.sprinkling = True
-        self.processes = []
 
-    def process_line(self, input_line):
-        split_line = input_line.rstrip("\n").split(" ")
+        # Candidates for the corner points of the cell being read, set up once the bbox and cell size are known
+        self.corner_seeds = None
+
+        # Splits dense cells before they are queued, set up together with the corner seeds
+        self.subdivider = None
+
+        self.pool = CellPool(self.triangulation.finalize, PROCESS_COUNT)
+
+        # Cells waiting for a free worker are queued, and spilled to disk past the memory budget, instead of blocking the input
+        self.pending = PendingCells(self.pool, PENDING_MEMORY_BUDGET, SPILL_BUDGET)
 
-        identifier = split_line[0]
-        data = split_line[1:]
+    def finish_cell(self, ticket, points, output):
+        self.points.release(points)
 
-        if identifier == "#" or identifier == "":
-            if data[0] == "endsprinkle":
-                self.sprinkling = False
-                sys.stderr.write("Sprinkling done!\n")
+        # A failed cell produces no output, as before
+        self.output.complete(ticket, output)
+
+    def process_event(self, event):
+        identifier = event.identifier
+
+        if identifier == "#":
+            # endsprinkle
+            self.sprinkling = False
+            sys.stderr.write("Sprinkling done!\n")
 
         elif identifier == "n":
             # Total number of points
-            self.triangulation.total_points = int(data[0])
-            sys.stdout.write(input_line)
+            self.triangulation.total_points = int(event.values[0])
+            self.output.write(event.text)
 
         elif identifier == "c":
             # Grid dimensions (cXc)
-            sys.stdout.write(input_line)
+            self.output.write(event.text)
 
         elif identifier == "s":
             # Cell size
-            self.triangulation.cell_size = int(data[0])
-            sys.stdout.write(input_line)
+            self.triangulation.cell_size = int(event.values[0])
+            self.output.write(event.text)
 
         elif identifier == "b":
             # bbox
-            self.triangulation.set_bbox(float(data[0]), float(data[1]), float(data[2]), float(data[3]))
-            sys.stdout.write(input_line)
+            self.triangulation.set_bbox(float(event.values[0]), float(event.values[1]), float(event.values[2]), float(event.values[3]))
+            self.corner_seeds = CornerSeeds(self.triangulation.min_x, self.triangulation.min_y, self.triangulation.cell_size)
+            self.subdivider = CellSubdivider(self.triangulation.min_x, self.triangulation.min_y, self.triangulation.cell_size, SUBDIVISION_THRESHOLD, self.points)
+            self.output.write(event.text)
 
         elif identifier == "v":
             # vertex
             # All sprinkle points get passed to output directly
             if not self.sprinkling:
-                self.triangulation.insert_vertex(float(data[0]), float(data[1]), float(data[2]))
+                self.points.extend(event.points)
+                self.corner_seeds.add(event.points)
 
             else:
-                sys.stdout.write(input_line)
+                self.output.write(event.text)
 
         elif identifier == "x":
             # cell finalizer
             # While sprinkling, don't bother processing since all finalized cells now are still empty anyways
             if self.sprinkling:
-                sys.stdout.write(input_line)
+                self.output.write(event.text)
                 return
 
-            sys.stderr.write("Starting new process to finalize cell: {}, {}. Processing currently running: {}\n".format(data[0], data[1], len(self.processes)))
+            sys.stderr.write("Submitting cell to worker pool: {}, {}. Cells currently running: {}, queued: {}\n".format(event.grid_x, event.grid_y, self.pool.running, len(self.pending)))
             sys.stderr.flush()
 
-            sleep_time = 1
-
-            # Ensure total number of processes never exceeds capacity
-            while len(self.processes) >= cpu_count() - 4:
-                for i in reversed(range(len(self.processes))):
-                    if not self.processes[i].is_alive():
-                        del self.processes[i]
-
-                time.sleep(sleep_time)
+            points = self.points.take()
+            corner_seeds = self.corner_seeds.take(event.grid_x, event.grid_y)
+            ticket = self.output.reserve()
 
-            process = Process(target=self.triangulation.finalize, args=(input_line, int(data[0]), int(data[1]), self.triangulation.vertices))
-            self.triangulation.vertices = {}
-            self.triangulation.vertex_id = 1
-            self.processes.append(process)
-            process.start()
+            self.subdivider.submit(self.pending, event.text, event.grid_x, event.grid_y, corner_seeds, points, callback=partial(self.finish_cell, ticket))
 
         else:
             # Unknown identifier in stream
             pass
 
-        sys.stdout.flush()
-
 
 if __name__ == "__main__":
     triangulation = Triangulation()
     processor = Processor(triangulation)
 
-    for stdin_line in sys.stdin:
-        processor.process_line(stdin_line)
+    for event in read_events(sys.stdin.buffer):
+        processor.process_event(event)
+
+    processor.pending.join()
+    processor.writer.close()
+
+    if INSERTION_LOG is not None:
+        processor.output.close()
+
+    if LEVELS_OF_DETAIL is not None:
+        processor.levels_of_detail.close()
 
-    for process in processor.processes:
-        process.join()
+    processor.points.close()
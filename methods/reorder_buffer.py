@@ -0,0 +1,94 @@
+import threading
+
+# Bytes of finished cell output held back for an earlier, slower cell before falling back to completion order
+MAX_HELD_SIZE = 1 << 28
+
+
+class ReorderBuffer:
+    def __init__(self, writer, max_held_size=MAX_HELD_SIZE):
+        self.writer = writer
+        self.max_held_size = max_held_size
+
+        # Tickets are handed out in stream order; next_output is the ticket that has to be written next
+        self.next_ticket = 0
+        self.next_output = 0
+
+        # ticket -> output that is finished but waiting for earlier tickets
+        self.held = {}
+        self.held_size = 0
+
+        # Tickets that were given up on when the buffer ran full; written as soon as they finish
+        self.late = set()
+
+        # Cells are completed from the pool's collector thread
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+
+        return ticket
+
+    def write(self, output):
+        # Pass-through lines keep their place relative to the cells around them
+        self.complete(self.reserve(), output)
+
+    def complete(self, ticket, output):
+        with self.lock:
+            if ticket in self.late:
+                self.late.remove(ticket)
+
+                if output:
+                    self.writer.write(output)
+                    self.writer.flush()
+
+                return
+
+            # A failed cell has no output but still has to release the cells after it
+            self.held[ticket] = output or ""
+            self.held_size += len(self.held[ticket])
+
+            written = self.drain()
+
+            if self.held_size > self.max_held_size:
+                written = self.give_up() or written
+
+            if written:
+                self.writer.flush()
+
+    def drain(self):
+        written = False
+
+        while self.next_output in self.held:
+            output = self.held.pop(self.next_output)
+            self.held_size -= len(output)
+            self.next_output += 1
+
+            if output:
+                self.writer.write(output)
+                written = True
+
+        return written
+
+    def give_up(self):
+        # Write everything that is finished, in ticket order, and let the slow cells through whenever they are done
+        last_held = max(self.held)
+
+        for ticket in range(self.next_output, last_held + 1):
+            if ticket not in self.held:
+                self.late.add(ticket)
+
+        written = False
+
+        for ticket in sorted(self.held):
+            output = self.held.pop(ticket)
+
+            if output:
+                self.writer.write(output)
+                written = True
+
+        self.held_size = 0
+        self.next_output = last_held + 1
+
+        return written
@@ -0,0 +1,142 @@
+import threading
+
+import numpy as np
+
+from multiprocessing import shared_memory
+
+# Number of points (x, y, z float64) per shared memory segment
+SEGMENT_POINTS = 1 << 20
+
+POINT_SIZE = 3 * np.dtype(np.float64).itemsize
+
+# Segments attached by this (worker) process, keyed by name
+attached_segments = {}
+
+
+class SharedPoints:
+    def __init__(self, name, offset, count):
+        self.name = name
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def attach(self):
+        segment = attached_segments.get(self.name)
+
+        if segment is None:
+            # Cells arrive in stream order, so a worker never needs an older segment again
+            for name in list(attached_segments):
+                try:
+                    attached_segments.pop(name).close()
+
+                # A view into it is still alive somewhere; leave it to the garbage collector
+                except BufferError:
+                    pass
+
+            segment = shared_memory.SharedMemory(name=self.name)
+            attached_segments[self.name] = segment
+
+        return np.ndarray((self.count, 3), dtype=np.float64, buffer=segment.buf, offset=self.offset * POINT_SIZE)
+
+
+class SharedPointArena:
+    def __init__(self, segment_points=SEGMENT_POINTS):
+        self.segment_points = segment_points
+
+        # name -> [SharedMemory, array, number of cells handed out and not yet released]
+        self.segments = {}
+
+        self.current = None
+        self.points = None
+
+        # First point of the cell being accumulated, and one past its last point
+        self.start = 0
+        self.end = 0
+
+        # Cells are released from the pool's collector thread
+        self.lock = threading.Lock()
+
+        self.new_segment(segment_points)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def new_segment(self, capacity):
+        segment = shared_memory.SharedMemory(create=True, size=capacity * POINT_SIZE)
+        points = np.ndarray((capacity, 3), dtype=np.float64, buffer=segment.buf)
+
+        # Move the part of the current cell that is already written into the new segment
+        count = self.end - self.start
+
+        if count > 0:
+            points[:count] = self.points[self.start:self.end]
+
+        with self.lock:
+            previous = self.current
+
+            self.segments[segment.name] = [segment, points, 0]
+            self.current = segment.name
+            self.points = points
+
+            self.start = 0
+            self.end = count
+
+            if previous is not None and self.segments[previous][2] == 0:
+                self.unlink(previous)
+
+    def append(self, x, y, z):
+        if self.end == len(self.points):
+            self.new_segment(max(self.segment_points, 2 * (self.end - self.start)))
+
+        self.points[self.end] = (x, y, z)
+        self.end += 1
+
+    def extend(self, points):
+        if self.end + len(points) > len(self.points):
+            self.new_segment(max(self.segment_points, 2 * (self.end - self.start + len(points))))
+
+        self.points[self.end:self.end + len(points)] = points
+        self.end += len(points)
+
+    def take(self):
+        # Hand off the current cell; costs O(1) regardless of the number of points in it
+        with self.lock:
+            self.segments[self.current][2] += 1
+
+        shared_points = SharedPoints(self.current, self.start, self.end - self.start)
+        self.start = self.end
+
+        return shared_points
+
+    def view(self, shared_points):
+        # The points of a cell handed out, for the main process itself; attaching would map the segment a second time,
+        # and that mapping would outlive the unlink
+        with self.lock:
+            points = self.segments[shared_points.name][1]
+
+        return points[shared_points.offset:shared_points.offset + shared_points.count]
+
+    def release(self, shared_points):
+        with self.lock:
+            self.segments[shared_points.name][2] -= 1
+
+            if self.segments[shared_points.name][2] == 0 and shared_points.name != self.current:
+                self.unlink(shared_points.name)
+
+    def unlink(self, name):
+        segment, points, _ = self.segments.pop(name)
+
+        del points
+
+        segment.close()
+        segment.unlink()
+
+    def close(self):
+        with self.lock:
+            self.current = None
+            self.points = None
+
+            for name in list(self.segments):
+                self.unlink(name)
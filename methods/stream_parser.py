@@ -0,0 +1,301 @@
+import re
+
+import numpy as np
+
+from ast import literal_eval
+
+from binary_stream import MAGIC, RECORD, HEADER, VERTICES, FINALIZER, END_SPRINKLE, FINALIZER_PAYLOAD, VERTEX_DTYPE
+
+# Most bytes read from the input stream at once; a read returns as soon as there is any input
+BLOCK_SIZE = 1 << 22
+
+# Start of the first line in a block that is not a vertex
+NON_VERTEX_LINE = re.compile(rb"\n[^v]")
+
+# Start of the first line in a block that is not a star (vertex finalizer written by sstdt)
+NON_STAR_LINE = re.compile(rb"\n[^x]")
+
+# Star records without neighbours
+EMPTY_STAR = re.compile(rb"\[\s*\]")
+
+# Everything in a star record that is not a number
+STAR_PUNCTUATION = bytes.maketrans(b"x[],", b"    ")
+
+
+class Header:
+    def __init__(self, identifier, values, text):
+        # n (number of points), c (grid dimensions), s (cell size) or b (bbox)
+        self.identifier = identifier
+        self.values = values
+        self.text = text
+
+
+class VertexBatch:
+    identifier = "v"
+
+    def __init__(self, points, text=None):
+        # (N, 3) float64 array of a run of consecutive v lines, together with their original text
+        self.points = points
+        self.original_text = text
+
+    @property
+    def text(self):
+        # Batches read from a binary stream only get a text form when something asks for it
+        if self.original_text is None:
+            self.original_text = "".join(["v {} {} {}\n".format(x, y, z) for x, y, z in self.points.tolist()])
+
+        return self.original_text
+
+
+class CellFinalize:
+    identifier = "x"
+
+    def __init__(self, grid_x, grid_y, text):
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        self.text = text
+
+
+class EndSprinkle:
+    identifier = "#"
+
+    def __init__(self, text):
+        self.text = text
+
+
+class StarBatch:
+    identifier = "x"
+
+    def __init__(self, indexes, neighbors):
+        # A run of consecutive star records: vertex ids and the neighbour ids of each
+        self.indexes = indexes
+        self.neighbors = neighbors
+
+
+def parse_vertices(chunk):
+    line_count = chunk.count(b"\n")
+
+    # The "v" identifiers are the only non-numeric tokens in a run of vertex lines
+    try:
+        values = np.fromstring(chunk.replace(b"v", b" "), dtype=np.float64, sep=" ")
+
+        if values.size == 3 * line_count:
+            return values.reshape(line_count, 3)
+
+    except ValueError:
+        pass
+
+    # Lines with more (or fewer) fields than x y z; fall back to parsing them one by one
+    return np.array([[float(value) for value in line.split()[1:4]] for line in chunk.splitlines()], dtype=np.float64)
+
+
+def parse_stars(chunk):
+    # "x <id> [<neighbour>, <neighbour>, ...]" lines; all ids are read with one NumPy call instead of literal_eval per line
+    data = np.frombuffer(chunk, dtype=np.uint8)
+
+    line_ends = np.flatnonzero(data == ord("\n"))
+    commas = np.flatnonzero(data == ord(","))
+
+    empty = np.array([match.start() for match in EMPTY_STAR.finditer(chunk)], dtype=np.int64)
+
+    # Neighbours per line: one more than its commas, none for an empty list
+    counts = np.diff(np.searchsorted(commas, line_ends), prepend=0) + 1
+    counts -= np.bincount(np.searchsorted(line_ends, empty), minlength=len(line_ends))
+
+    try:
+        values = np.fromstring(chunk.translate(STAR_PUNCTUATION), dtype=np.int64, sep=" ")
+
+        if values.size != counts.sum() + len(counts):
+            raise ValueError
+
+    except ValueError:
+        # Records in an unexpected layout; fall back to parsing them one by one
+        stars = [line.decode().split(" ", 2) for line in chunk.splitlines()]
+
+        return StarBatch([int(star[1]) for star in stars], [literal_eval(star[2].replace(" ", "")) if len(star) > 2 else [] for star in stars])
+
+    values = values.tolist()
+
+    # Each line is its id followed by its neighbours
+    starts = np.cumsum(counts + 1) - counts - 1
+
+    return StarBatch([values[start] for start in starts.tolist()], [values[start + 1:start + 1 + count] for start, count in zip(starts.tolist(), counts.tolist())])
+
+
+def parse_star_block(block):
+    position = 0
+
+    while position < len(block):
+        if block[position] == ord("x"):
+            match = NON_STAR_LINE.search(block, position)
+            end = match.start() + 1 if match else len(block)
+
+            yield parse_stars(block[position:end])
+
+        else:
+            end = block.index(b"\n", position) + 1
+
+            yield block[position:end].decode()
+
+        position = end
+
+
+def parse_record(line):
+    split_line = line.rstrip("\n").split(" ")
+
+    identifier = split_line[0]
+    data = split_line[1:]
+
+    if identifier == "#" or identifier == "":
+        if data and data[0] == "endsprinkle":
+            return EndSprinkle(line)
+
+    elif identifier in ("n", "c", "s", "b"):
+        return Header(identifier, data, line)
+
+    elif identifier == "x":
+        return CellFinalize(int(data[0]), int(data[1]), line)
+
+    elif identifier == "v":
+        return VertexBatch(np.array([[float(data[0]), float(data[1]), float(data[2])]], dtype=np.float64), line)
+
+    # Unknown identifier in stream
+    return None
+
+
+def parse_block(block):
+    position = 0
+
+    while position < len(block):
+        if block[position] == ord("v"):
+            # Hand the whole run of vertex lines to NumPy at once
+            match = NON_VERTEX_LINE.search(block, position)
+            end = match.start() + 1 if match else len(block)
+
+            chunk = block[position:end]
+
+            yield VertexBatch(parse_vertices(chunk), chunk.decode())
+
+        else:
+            end = block.index(b"\n", position) + 1
+
+            event = parse_record(block[position:end].decode())
+
+            if event is not None:
+                yield event
+
+        position = end
+
+
+class PrefixedStream:
+    def __init__(self, prefix, stream):
+        # Bytes already taken from the stream, served before reading from the stream itself
+        self.prefix = prefix
+        self.position = 0
+        self.stream = stream
+
+    def read(self, size):
+        if self.position >= len(self.prefix):
+            return self.stream.read(size)
+
+        data = self.prefix[self.position:self.position + size]
+        self.position += len(data)
+
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+
+        return data
+
+
+def read_binary_events(stream):
+    while True:
+        record = stream.read(RECORD.size)
+
+        if len(record) < RECORD.size:
+            break
+
+        record_type, length = RECORD.unpack(record)
+        payload = stream.read(length)
+
+        if record_type == VERTICES:
+            yield VertexBatch(np.frombuffer(payload, dtype=VERTEX_DTYPE).reshape(-1, 3))
+
+        elif record_type == FINALIZER:
+            grid_x, grid_y = FINALIZER_PAYLOAD.unpack(payload)
+
+            yield CellFinalize(grid_x, grid_y, "x {} {}\n".format(grid_x, grid_y))
+
+        elif record_type == END_SPRINKLE:
+            yield EndSprinkle("# endsprinkle\n")
+
+        elif record_type == HEADER:
+            event = parse_record(payload.decode())
+
+            if event is not None:
+                yield event
+
+        # Unknown record types are skipped
+
+
+def read_available(stream, size):
+    # Whatever input is there, up to size bytes; read() on a buffered stream would wait for all of them, holding back
+    # finalizers that already came through a pipe. Raw streams have no read1, and their read already returns early
+    read1 = getattr(stream, "read1", None)
+
+    if read1 is None:
+        return stream.read(size)
+
+    return read1(size)
+
+
+def read_blocks(stream, block_size=BLOCK_SIZE, data=None):
+    if data is None:
+        data = read_available(stream, block_size)
+
+    remainder = b""
+
+    while data:
+        block = remainder + data
+
+        # Only parse complete lines, keep the rest for the next block
+        last_newline = block.rfind(b"\n")
+
+        if last_newline == -1:
+            remainder = block
+
+        else:
+            remainder = block[last_newline + 1:]
+
+            yield block[:last_newline + 1]
+
+        data = read_available(stream, block_size)
+
+    if remainder:
+        yield remainder + b"\n"
+
+
+def read_events(stream, block_size=BLOCK_SIZE):
+    data = read_available(stream, block_size)
+
+    # Enough of the input to tell the formats apart
+    while data and len(data) < len(MAGIC) and MAGIC.startswith(data):
+        more = read_available(stream, block_size)
+
+        if not more:
+            break
+
+        data += more
+
+    # Binary streams (see binary_stream.py) are recognised by their first bytes, anything else is sst text
+    if data.startswith(MAGIC):
+        yield from read_binary_events(PrefixedStream(data[len(MAGIC):], stream))
+        return
+
+    for block in read_blocks(stream, block_size, data):
+        yield from parse_block(block)
+
+
+def read_star_records(stream, block_size=BLOCK_SIZE):
+    # sstdt output for decimation: StarBatch for runs of star records, the other lines as text
+    for block in read_blocks(stream, block_size):
+        yield from parse_star_block(block)
@@ -0,0 +1,101 @@
+import threading
+
+# Bytes collected before they are handed to the writer thread
+BUFFER_SIZE = 1 << 20
+
+# Seconds after which buffered output is written even if the buffer is not full yet
+FLUSH_INTERVAL = 1.0
+
+# Bytes handed to the writer thread but not yet written before write() starts to block
+MAX_QUEUED_SIZE = 1 << 26
+
+
+class StreamWriter:
+    def __init__(self, stream, buffer_size=BUFFER_SIZE, flush_interval=FLUSH_INTERVAL, max_queued_size=MAX_QUEUED_SIZE):
+        self.stream = stream
+
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_queued_size = max_queued_size
+
+        # Output that is still being coalesced
+        self.chunks = []
+        self.size = 0
+
+        # Coalesced output waiting for the writer thread, in the order it was written
+        self.batches = []
+        self.queued_size = 0
+
+        self.closed = False
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+
+        with self.condition:
+            self.chunks.append(data)
+            self.size += len(data)
+
+            if self.size >= self.buffer_size:
+                self.hand_off()
+
+                # Downstream (sstdt) can't keep up; stop producing instead of queueing without bound
+                while self.queued_size > self.max_queued_size:
+                    self.condition.wait()
+
+    def flush(self):
+        # Called on cell boundaries, so a finished cell reaches the next stage without waiting for the buffer to fill
+        with self.condition:
+            self.hand_off()
+
+    def hand_off(self):
+        if not self.chunks:
+            return
+
+        self.batches.append(b"".join(self.chunks))
+        self.queued_size += self.size
+
+        self.chunks = []
+        self.size = 0
+
+        self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.batches and not self.closed:
+                    self.condition.wait(self.flush_interval)
+
+                    # Nothing was handed off in time; write what has been collected so far
+                    if not self.batches:
+                        self.hand_off()
+
+                batches = self.batches
+                self.batches = []
+
+                closed = self.closed
+
+            for batch in batches:
+                self.stream.write(batch)
+
+            if batches:
+                self.stream.flush()
+
+                with self.condition:
+                    self.queued_size -= sum(len(batch) for batch in batches)
+                    self.condition.notify_all()
+
+            elif closed:
+                break
+
+    def close(self):
+        with self.condition:
+            self.hand_off()
+            self.closed = True
+            self.condition.notify_all()
+
+        self.thread.join()
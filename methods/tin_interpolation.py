@@ -0,0 +1,135 @@
+import numpy as np
+
+from triangle_buckets import EPSILON, barycentric_pairs
+
+# Cells of the triangle index per triangle; each cell then overlaps a handful of triangles
+CELLS_PER_TRIANGLE = 1.0
+
+# Points evaluated at once; bounds the memory of the (point, candidate triangle) pairs
+CHUNK_SIZE = 1 << 16
+
+
+class TriangleIndex:
+    def __init__(self, vertices, triangles, cells_per_triangle=CELLS_PER_TRIANGLE):
+        # vertices: (V, 3) coordinates by vertex id, triangles: (T, 3) vertex ids
+        self.vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+        self.triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+
+        corners = self.vertices[self.triangles]
+
+        # Zero-area triangles contain no point but would give NaN weights, which hide the triangle the point is in
+        edge_1 = corners[:, 1, :2] - corners[:, 0, :2]
+        edge_2 = corners[:, 2, :2] - corners[:, 0, :2]
+
+        non_degenerate = edge_1[:, 0] * edge_2[:, 1] - edge_2[:, 0] * edge_1[:, 1] != 0
+
+        self.triangles = self.triangles[non_degenerate]
+        corners = corners[non_degenerate]
+
+        if len(self.triangles) == 0:
+            self.low = np.zeros(2)
+            self.cell_size = np.ones(2)
+            self.cells = np.ones(2, dtype=np.int64)
+            self.cell_start = np.zeros(2, dtype=np.int64)
+            self.cell_triangles = np.empty(0, dtype=np.int64)
+            return
+
+        triangle_low = corners[:, :, :2].min(axis=1)
+        triangle_high = corners[:, :, :2].max(axis=1)
+
+        self.low = triangle_low.min(axis=0)
+        extent = np.maximum(triangle_high.max(axis=0) - self.low, 1E-9)
+
+        # A uniform grid with about cells_per_triangle cells per triangle, following the aspect ratio of the TIN
+        cell_count = max(1.0, len(self.triangles) * cells_per_triangle)
+        cells_x = max(1, int(round(np.sqrt(cell_count * extent[0] / extent[1]))))
+        cells_y = max(1, int(round(cell_count / cells_x)))
+
+        self.cells = np.array([cells_x, cells_y], dtype=np.int64)
+        self.cell_size = extent / self.cells
+
+        first_cell = self.cell_of(triangle_low)
+        last_cell = self.cell_of(triangle_high)
+
+        # Register every triangle in all cells its bounding box overlaps
+        spans = last_cell - first_cell + 1
+        counts = spans[:, 0] * spans[:, 1]
+
+        triangle_ids = np.repeat(np.arange(len(self.triangles)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        cell_x = first_cell[triangle_ids, 0] + offsets % spans[triangle_ids, 0]
+        cell_y = first_cell[triangle_ids, 1] + offsets // spans[triangle_ids, 0]
+
+        cell_ids = cell_x * cells_y + cell_y
+        order = np.argsort(cell_ids, kind="stable")
+
+        # Triangles of cell c are cell_triangles[cell_start[c]:cell_start[c + 1]]
+        self.cell_triangles = triangle_ids[order]
+        self.cell_start = np.searchsorted(cell_ids[order], np.arange(cells_x * cells_y + 1))
+
+    @classmethod
+    def from_triangulation(cls, triangulation):
+        # Removed vertices keep their id, the infinite vertex 0 only shows up in triangles on the hull
+        triangles = np.array(triangulation.all_triangles(), dtype=np.int64).reshape(-1, 3)
+        triangles = triangles[(triangles != 0).all(axis=1)]
+
+        return cls(triangulation.all_vertices(), triangles)
+
+    def cell_of(self, points):
+        return np.clip(np.floor((points - self.low) / self.cell_size).astype(np.int64), 0, self.cells - 1)
+
+    def interpolate(self, points):
+        # Linear interpolation of (N, 2+) points; returns the z values (NaN outside) and the mask of points outside the hull
+        points = np.asarray(points, dtype=np.float64).reshape(len(points), -1)
+
+        values = np.full(len(points), np.nan)
+
+        for start in range(0, len(points), CHUNK_SIZE):
+            values[start:start + CHUNK_SIZE] = self.interpolate_chunk(points[start:start + CHUNK_SIZE, :2])
+
+        return values, np.isnan(values)
+
+    def interpolate_chunk(self, points):
+        values = np.full(len(points), np.nan)
+
+        if len(self.cell_triangles) == 0:
+            return values
+
+        # Points beyond the grid are outside every triangle; the others only need the triangles of their cell
+        on_grid = ((points >= self.low) & (points <= self.low + self.cells * self.cell_size)).all(axis=1)
+
+        cells = self.cell_of(points)
+        cell_ids = cells[:, 0] * self.cells[1] + cells[:, 1]
+
+        starts = self.cell_start[cell_ids]
+        counts = np.where(on_grid, self.cell_start[cell_ids + 1] - starts, 0)
+
+        pair_points = np.repeat(np.arange(len(points)), counts)
+        pair_triangles = self.cell_triangles[np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+
+        if len(pair_points) == 0:
+            return values
+
+        corners = self.vertices[self.triangles[pair_triangles]]
+
+        weight_0, weight_1, weight_2 = barycentric_pairs(corners, points[pair_points])
+
+        containment = np.minimum(np.minimum(weight_0, weight_1), weight_2)
+
+        # Per point, the candidate triangle it is deepest inside of
+        deepest = np.full(len(points), -np.inf)
+        np.maximum.at(deepest, pair_points, containment)
+
+        best = np.flatnonzero(containment == deepest[pair_points])
+        best = best[np.unique(pair_points[best], return_index=True)[1]]
+        best = best[containment[best] >= -EPSILON]
+
+        values[pair_points[best]] = weight_0[best] * corners[best, 0, 2] + weight_1[best] * corners[best, 1, 2] + weight_2[best] * corners[best, 2, 2]
+
+        return values
+
+
+def interpolate_tin_linear(triangulation, points):
+    # Batch counterpart of triangulation.interpolate_tin_linear(x, y) for a triangulation that doesn't change meanwhile
+    return TriangleIndex.from_triangulation(triangulation).interpolate(points)
@@ -0,0 +1,129 @@
+import numpy as np
+
+# Barycentric tolerance for points on the boundary of the triangulation's convex hull
+EPSILON = 1E-9
+
+
+def triangle_key(triangle):
+    # Triangle ordering may be different; [1, 2, 3] == [3, 1, 2] == [2, 3, 1]
+    return tuple(sorted(triangle))
+
+
+def barycentric(corners, points):
+    # corners: (triangles, 3, 3) vertex coordinates, points: (n, 2); returns three (triangles, n) coordinate arrays
+    return barycentric_pairs(corners[:, None], points[None])
+
+
+def barycentric_pairs(corners, points):
+    # corners: (..., 3, 3) vertex coordinates, points: (..., 2) broadcast against them, e.g. one triangle per point
+    origin = corners[..., 0, :2]
+
+    edge_1 = corners[..., 1, :2] - origin
+    edge_2 = corners[..., 2, :2] - origin
+    offset = points[..., :2] - origin
+
+    # Relative to the first corner, so large (projected) coordinates don't cost precision
+    denominator = edge_1[..., 0] * edge_2[..., 1] - edge_2[..., 0] * edge_1[..., 1]
+
+    weight_1 = (offset[..., 0] * edge_2[..., 1] - edge_2[..., 0] * offset[..., 1]) / denominator
+    weight_2 = (edge_1[..., 0] * offset[..., 1] - offset[..., 0] * edge_1[..., 1]) / denominator
+
+    return 1 - weight_1 - weight_2, weight_1, weight_2
+
+
+class TriangleBuckets:
+    def __init__(self, points, vertices):
+        self.points = points
+
+        # Coordinates of the vertices in the triangulation by vertex id
+        self.vertices = dict(vertices)
+
+        # Live triangles by sorted vertex ids -> indexes (into points) of the not yet inserted points inside them
+        self.buckets = {}
+
+        # Vertex id -> keys of the live triangles around it
+        self.vertex_triangles = {}
+
+    def assign(self, triangles, point_indexes):
+        # Returns [(key, triangle, point indexes, errors)] for the finite triangles, and the indexes outside all of them
+        triangles = [triangle for triangle in triangles if 0 not in triangle]
+
+        if not triangles:
+            return [], point_indexes
+
+        corners = np.array([[self.vertices[vertex_id] for vertex_id in triangle] for triangle in triangles])
+        candidates = self.points[point_indexes]
+
+        weight_0, weight_1, weight_2 = barycentric(corners, candidates)
+
+        # Every candidate goes to exactly one triangle: the one it is deepest inside of, which also settles points on
+        # shared edges and tiny rounding errors along the boundary
+        containment = np.minimum(np.minimum(weight_0, weight_1), weight_2)
+        buckets = containment.argmax(axis=0)
+
+        inside = containment[buckets, np.arange(len(point_indexes))] >= -EPSILON
+
+        # Linear interpolation in the triangle each point falls in, for all points at once
+        interpolated = weight_0 * corners[:, 0, None, 2] + weight_1 * corners[:, 1, None, 2] + weight_2 * corners[:, 2, None, 2]
+        errors = np.abs(candidates[:, 2] - interpolated[buckets, np.arange(len(point_indexes))])
+
+        assigned = []
+
+        for bucket, triangle in enumerate(triangles):
+            in_bucket = inside & (buckets == bucket)
+
+            key = triangle_key(triangle)
+            self.buckets[key] = point_indexes[in_bucket]
+
+            for vertex_id in key:
+                self.vertex_triangles.setdefault(vertex_id, set()).add(key)
+
+            assigned.append((key, triangle, point_indexes[in_bucket], errors[in_bucket]))
+
+        return assigned, point_indexes[~inside]
+
+    def insert(self, triangulation, point_index):
+        # Inserts a point and redistributes the points of the triangles it destroys; returns the destroyed keys and
+        # the assignment of the new triangles
+        x, y, z = self.points[point_index].tolist()
+
+        vertex_id = triangulation.insert_one_pt(x, y, z, 0)
+        self.vertices.setdefault(vertex_id, (x, y, z))
+
+        incident_triangles = [triangle for triangle in triangulation.incident_triangles_to_vertex(vertex_id) or [] if 0 not in triangle]
+
+        new_triangles = [triangle for triangle in incident_triangles if triangle_key(triangle) not in self.buckets]
+
+        if new_triangles:
+            # The triangles destroyed by the insertion all have their corners on the ring around the new vertex, and
+            # they are the only such triangles whose centroid lies inside the new fan of triangles
+            ring = set(vertex for triangle in incident_triangles for vertex in triangle) - {vertex_id}
+
+            candidates = list(set(key for vertex in ring for key in self.vertex_triangles.get(vertex, ()) if ring.issuperset(key)))
+
+            corners = np.array([[self.vertices[vertex] for vertex in triangle] for triangle in new_triangles])
+            centroids = np.array([np.mean([self.vertices[vertex] for vertex in key], axis=0) for key in candidates]).reshape(-1, 3)
+
+            weight_0, weight_1, weight_2 = barycentric(corners, centroids)
+            is_destroyed = (np.minimum(np.minimum(weight_0, weight_1), weight_2) > 0).any(axis=0)
+
+            destroyed = [key for key, key_destroyed in zip(candidates, is_destroyed) if key_destroyed]
+
+        else:
+            # A duplicate of an existing vertex changes nothing but the candidates of the triangle the point was in
+            destroyed = [key for key, point_indexes in self.buckets.items() if point_index in point_indexes]
+            new_triangles = [list(key) for key in destroyed]
+
+        for key in destroyed:
+            for vertex in key:
+                self.vertex_triangles[vertex].discard(key)
+
+        # Redistribute the points of the destroyed triangles over the new ones, testing each point once
+        point_indexes = np.concatenate([self.buckets.pop(key) for key in destroyed] + [np.empty(0, dtype=np.int64)])
+
+        # Inserted this point, no need to keep it in the buckets
+        point_indexes = point_indexes[point_indexes != point_index]
+
+        assigned, _ = self.assign(new_triangles, point_indexes)
+
+        return destroyed, assigned
@@ -0,0 +1,79 @@
+from heapq import heapify, heappop, heappush
+
+# Share of stale entries in the heap at which it is rebuilt from the live entries only
+COMPACTION_RATIO = 0.5
+
+# Heaps smaller than this are never compacted; popping past their stale entries is cheap enough
+MIN_COMPACTION_SIZE = 1024
+
+
+class VersionedHeap:
+    def __init__(self, compaction_ratio=COMPACTION_RATIO, min_compaction_size=MIN_COMPACTION_SIZE):
+        self.compaction_ratio = compaction_ratio
+        self.min_compaction_size = min_compaction_size
+
+        # [priority, version, key]; versions count up, so equal priorities pop in push order and keys are never compared
+        self.entries = []
+        self.next_version = 0
+
+        # key -> its one live entry; pushing or discarding a key makes its older entries stale
+        self.versions = {}
+
+    def __len__(self):
+        return len(self.versions)
+
+    def __contains__(self, key):
+        return key in self.versions
+
+    def keys(self):
+        return list(self.versions)
+
+    def priority(self, key):
+        return self.versions[key][0]
+
+    def push(self, key, priority):
+        # Smallest priority pops first
+        entry = [priority, self.next_version, key]
+
+        self.versions[key] = entry
+
+        heappush(self.entries, entry)
+        self.next_version += 1
+
+        self.compact()
+
+    def discard(self, key):
+        if self.versions.pop(key, None) is not None:
+            self.compact()
+
+    def is_live(self, entry):
+        return self.versions.get(entry[2]) is entry
+
+    def skip_stale(self):
+        # Stale entries are only dropped once they reach the top, in O(1) each
+        while self.entries and not self.is_live(self.entries[0]):
+            heappop(self.entries)
+
+    def peek(self):
+        self.skip_stale()
+
+        priority, _, key = self.entries[0]
+
+        return priority, key
+
+    def pop(self):
+        self.skip_stale()
+
+        priority, _, key = heappop(self.entries)
+        del self.versions[key]
+
+        return priority, key
+
+    def compact(self):
+        stale_count = len(self.entries) - len(self.versions)
+
+        if len(self.entries) < self.min_compaction_size or stale_count <= self.compaction_ratio * len(self.entries):
+            return
+
+        self.entries = [entry for entry in self.entries if self.is_live(entry)]
+        heapify(self.entries)
@@ -0,0 +1,25 @@
+import numpy as np
+
+
+def format_vertices(vertices, excluded_ids=(), precision=None):
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+
+    # The infinite vertex (and removed vertices) have negative coordinates
+    kept = vertices[:, 0] > 0
+
+    excluded_ids = [vertex_id for vertex_id in excluded_ids if vertex_id < len(vertices)]
+    kept[excluded_ids] = False
+
+    values = vertices[kept].ravel().tolist()
+
+    if not values:
+        return ""
+
+    line_count = len(values) // 3
+
+    # One formatting call for the whole block instead of string concatenation per vertex
+    if precision is None:
+        # Same shortest round-trip representation as str(float)
+        return ("v {} {} {}\n" * line_count).format(*values)
+
+    return (("v %.{0}f %.{0}f %.{0}f\n".format(precision)) * line_count) % tuple(values)
@@ -0,0 +1,13 @@
+import os
+import sys
+
+# The stream format and parser are shared with the simplification methods
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "methods"))
+
+from stream_parser import read_events
+
+if __name__ == "__main__":
+    for event in read_events(sys.stdin.buffer):
+        sys.stdout.write(event.text)
+
+    sys.stdout.flush()
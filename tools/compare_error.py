@@ -1,10 +1,18 @@
+import os
 import sys
 import random
 
 import startin
 
+import numpy as np
+
 from geojson import Point, Feature, FeatureCollection, dump
 
+# The batch interpolation is shared with the simplification methods
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "methods"))
+
+from tin_interpolation import interpolate_tin_linear
+
 if __name__ == "__main__":
     arguments = sys.argv
     if len(arguments) != 4:
@@ -41,34 +49,24 @@ if __name__ == "__main__":
     # https://gis.stackexchange.com/questions/130963/write-geojson-into-a-geojson-file-with-python
     features = []
 
-    last_percentage = -1
-
     # interpolate 1/10 points
     THINNING = 10
 
     print("Going to interpolate {} vertices!".format(len(original_vertices)))
 
-    # For each vertex in the original DT ✔
-    for i in range(len(original_vertices)):
-        vertex = original_vertices[i]
-
-        if i % 10000 == 0:
-            percentage = round(i / len(original_vertices))
-            print(percentage, "% done")
-            if percentage != last_percentage:
-                print(percentage, "% done")
-                last_percentage = percentage
+    # Take 1/10 of the vertices in the original DT ✔
+    sampled_vertices = np.array([vertex for vertex in original_vertices if random.randint(0, THINNING) == THINNING / 2]).reshape(-1, 3)
 
-        if random.randint(0, THINNING) == THINNING / 2:
-            try:
-                # Interpolate the error for this vertex ✔
-                interpolated_value = simplified_triangulation.interpolate_tin_linear(vertex[0], vertex[1])
+    # Interpolate the error for all of them at once ✔
+    interpolated_values, outside = interpolate_tin_linear(simplified_triangulation, sampled_vertices)
 
-                # Attach error for vertex to vertex class ✔
-                features.append(Feature(geometry=Point((vertex[0], vertex[1], vertex[2])), properties={"error": abs(vertex[2] - interpolated_value)}))
+    for (x, y, z), interpolated_value, is_outside in zip(sampled_vertices.tolist(), interpolated_values.tolist(), outside.tolist()):
+        if is_outside:
+            print("Could not interpolate {}, {}; skipping.".format(x, y))
+            continue
 
-            except OSError:
-                print("Could not interpolate {}, {}; skipping.".format(vertex[0], vertex[1]))
+        # Attach error for vertex to vertex class ✔
+        features.append(Feature(geometry=Point((x, y, z)), properties={"error": abs(z - interpolated_value)}))
 
     # Output each vertex to a GeoJSON file including attribute error ✔
     feature_collection = FeatureCollection(features)
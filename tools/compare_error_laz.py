@@ -1,12 +1,20 @@
+import os
 import sys
 import random
 import subprocess
 
 import startin
 
+import numpy as np
+
 from math import floor
 from geojson import Point, Feature, FeatureCollection, dump
 
+# The batch interpolation is shared with the simplification methods
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "methods"))
+
+from tin_interpolation import interpolate_tin_linear
+
 if __name__ == "__main__":
     arguments = sys.argv
     if len(arguments) != 5:
@@ -42,26 +50,30 @@ if __name__ == "__main__":
     # https://gis.stackexchange.com/questions/130963/write-geojson-into-a-geojson-file-with-python
     features = []
 
+    sampled_vertices = []
+
     # For each vertex in the original DT ✔
     for line in las2txt.stdout:
         if random.randint(0, thinning_factor) == floor(thinning_factor / 2):
             stripped_line = str(line.rstrip(), "utf-8")
             split_line = stripped_line.split()
-            split_line = [float(val) for val in split_line]
 
-            x = split_line[0]
-            y = split_line[1]
-            z = split_line[2]
+            sampled_vertices.append([float(val) for val in split_line[:3]])
+
+    sampled_vertices = np.array(sampled_vertices).reshape(-1, 3)
+
+    print("Interpolating {} sampled vertices".format(len(sampled_vertices)))
 
-            try:
-                # Interpolate the error for this vertex ✔
-                interpolated_value = simplified_triangulation.interpolate_tin_linear(x, y)
+    # Interpolate the error for all sampled vertices at once ✔
+    interpolated_values, outside = interpolate_tin_linear(simplified_triangulation, sampled_vertices)
 
-                # Attach error for vertex to vertex class ✔
-                features.append(Feature(geometry=Point((x, y, z)), properties={"error": z - interpolated_value}))
+    for (x, y, z), interpolated_value, is_outside in zip(sampled_vertices.tolist(), interpolated_values.tolist(), outside.tolist()):
+        if is_outside:
+            print("Could not interpolate {}, {}; skipping.".format(x, y))
+            continue
 
-            except OSError:
-                print("Could not interpolate {}, {}; skipping.".format(x, y))
+        # Attach error for vertex to vertex class ✔
+        features.append(Feature(geometry=Point((x, y, z)), properties={"error": z - interpolated_value}))
 
     print("Creating feature collection")
 
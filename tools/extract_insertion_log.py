@@ -0,0 +1,31 @@
+import os
+import sys
+
+# The insertion log format is shared with the simplification methods
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "methods"))
+
+from insertion_log import extract_insertions
+
+if __name__ == "__main__":
+    arguments = sys.argv
+    if len(arguments) not in (3, 4):
+        print("Invalid number of arguments used!")
+        print("Usage: extract_insertion_log.py <insertion log> <threshold> [output precision]")
+        sys.exit()
+
+    input_log = sys.argv[1]
+    threshold = float(sys.argv[2])
+    precision = int(sys.argv[3]) if len(arguments) == 4 else None
+
+    with open(input_log, "rb") as log_file:
+        try:
+            for text in extract_insertions(log_file, threshold, precision):
+                sys.stdout.write(text)
+
+        # Not an insertion log, or points below the recorded threshold were never considered for insertion; stdout is
+        # the vertex stream, so the message goes to stderr
+        except ValueError as error:
+            sys.stderr.write("{}\n".format(error))
+            sys.exit(1)
+
+    sys.stdout.flush()
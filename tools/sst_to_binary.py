@@ -0,0 +1,18 @@
+import os
+import sys
+
+# The stream format and parser are shared with the simplification methods
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "methods"))
+
+from binary_stream import MAGIC, encode_event
+from stream_parser import read_events
+
+if __name__ == "__main__":
+    output = sys.stdout.buffer
+
+    output.write(MAGIC)
+
+    for event in read_events(sys.stdin.buffer):
+        output.write(encode_event(event))
+
+    output.flush()